@@ -36,6 +36,12 @@ V2_21 = '2.21'
 
 #------------------ Constants values ------------------------------------------
 
+# EMAN structure factor file, relative to the project folder
+STRUCFAC = 'strucfac.txt'
+
+# e2boxer neural net picker files, relative to the project folder
+CONVNET_FILES = ['nnet_pickptcls.hdf', 'nnet_classify.hdf']
+
 # ctf processing type
 HIRES = 0
 MIDRES = 1
@@ -177,6 +183,10 @@ AUTO_REF = 1
 AUTO_GAUSS = 2
 AUTO_CONVNET = 3
 
+# sparx gaussian picker engines
+GAUSS_EMAN = 0
+GAUSS_NUMPY = 1
+
 WIKI_URL = "[[http://blake.bcm.edu/emanwiki/EMAN2][Wiki]]"
 
 # viewer.py constants
@@ -28,32 +28,116 @@
 # *
 # **************************************************************************
 
-import glob
+import collections
+import contextlib
+import fcntl
+import hashlib
 import json
+from multiprocessing.pool import ThreadPool
 import numpy
 import os
+import threading
+import time
+
+try:
+    # faster json decoder, if installed
+    import ujson as jsonDecoder
+except ImportError:
+    jsonDecoder = json
 
 import pyworkflow.em as em
 import pyworkflow.utils as pwutils
-from pyworkflow.em.data import Coordinate, Particle
+from pyworkflow.em.data import Coordinate, Particle, CTFModel
 from pyworkflow.em.convert import ImageHandler
 import pyworkflow.em.metadata as md
 
 import eman2
+from eman2.constants import STRUCFAC, CONVNET_FILES
+
+
+# Number of threads used for file operations, e.g. linking stacks
+IO_THREADS = 8
+
+
+# CTFModel attributes filled from the EMAN info json files
+CTF_JSON_ATTRS = ['_defocusU', '_defocusV', '_defocusAngle', '_defocusRatio',
+                  '_psdFile', '_phaseShift']
+
+
+# Parsed json files are cached while their total size is below this
+JSON_CACHE_SIZE = 64 * 1024 * 1024
+
+# {jsonFn: ((mtime, size), jsonDict)}, least recently used first
+_jsonCache = collections.OrderedDict()
+_jsonCacheLock = threading.Lock()
+_jsonCacheStats = {'hits': 0, 'misses': 0, 'size': 0}
 
 
 def loadJson(jsonFn):
-    """ This function loads the Json dictionary into memory """
-    jsonFile = open(jsonFn)
-    jsonDict = json.load(jsonFile)
-    jsonFile.close()
+    """ This function loads the Json dictionary into memory.
+    The parsed dictionaries are cached (while the file is not modified),
+    so they should not be modified unless written back with writeJson.
+    """
+    st = os.stat(jsonFn)
+    key = (st.st_mtime, st.st_size)
+
+    with _jsonCacheLock:
+        cached = _jsonCache.pop(jsonFn, None)
+        if cached is not None and cached[0] == key:
+            _jsonCache[jsonFn] = cached
+            _jsonCacheStats['hits'] += 1
+            return cached[1]
+        if cached is not None:
+            _jsonCacheStats['size'] -= cached[0][1]
+        _jsonCacheStats['misses'] += 1
+
+    with open(jsonFn) as jsonFile:
+        data = jsonFile.read()
+    try:
+        jsonDict = jsonDecoder.loads(data)
+    except ValueError:
+        # e.g. NaN values, not supported by all decoders
+        jsonDict = json.loads(data)
+
+    with _jsonCacheLock:
+        if jsonFn not in _jsonCache and st.st_size <= JSON_CACHE_SIZE:
+            _jsonCache[jsonFn] = (key, jsonDict)
+            _jsonCacheStats['size'] += st.st_size
+        while _jsonCacheStats['size'] > JSON_CACHE_SIZE:
+            _, (oldKey, _) = _jsonCache.popitem(last=False)
+            _jsonCacheStats['size'] -= oldKey[1]
+
     return jsonDict
 
 
+def getJsonCacheStats():
+    """ Return a dict with the hits, misses and size (bytes) of the
+    loadJson cache.
+    """
+    with _jsonCacheLock:
+        return dict(_jsonCacheStats)
+
+
+def clearJsonCache():
+    with _jsonCacheLock:
+        _jsonCache.clear()
+        _jsonCacheStats.update(hits=0, misses=0, size=0)
+
+
 def writeJson(jsonDict, jsonFn):
-    """ This function write a Json dictionary """
-    with open(jsonFn, 'w') as outfile:
+    """ This function write a Json dictionary.
+    It is written to a temporary file that is renamed at the end, so
+    readers never get a partially written file.
+    """
+    with _jsonCacheLock:
+        cached = _jsonCache.pop(jsonFn, None)
+        if cached is not None:
+            _jsonCacheStats['size'] -= cached[0][1]
+    tmpFn = '%s.%d.%d.tmp' % (jsonFn, os.getpid(),
+                              threading.current_thread().ident)
+    with open(tmpFn, 'w') as outfile:
         json.dump(jsonDict, outfile)
+    os.rename(tmpFn, jsonFn)
 
 
 def readCTFModel(ctfModel, filename):
@@ -98,14 +182,233 @@ def writeCTFModel(ctfObj, filename):
     pass
 
 
+def getInfoJsonFn(particlesFn):
+    """ Return the micrograph info json file where EMAN stores
+    the CTF of the given particles stack: info/<base>_info.json in the
+    EMAN project of the stack (the parent of its particles/ folder),
+    where base is the stack name without the __ctf_flip like suffixes.
+    """
+    particlesFn = str(particlesFn)
+    projectPath = os.path.dirname(os.path.dirname(particlesFn))
+    baseName = pwutils.removeBaseExt(particlesFn).split('__')[0]
+    return os.path.join(projectPath, 'info', baseName + '_info.json')
+
+
 def jsonToCtfModel(ctfJsonFn, ctfModel):
     """ Create a CTFModel from a json file """
-    mdFn = str(ctfJsonFn).replace('particles', 'info')
-    mdFn = mdFn.split('__ctf_flip')[0] + '_info.json'
+    mdFn = getInfoJsonFn(ctfJsonFn)
     if pwutils.exists(mdFn):
         readCTFModel(ctfModel, mdFn)
 
 
+def updateCtfFromJson(ctfModel, particlesFn, cache):
+    """ Same as jsonToCtfModel, but the info json files are parsed only
+    once (or again if modified) and kept in the given cache dictionary,
+    so all particles from the same micrograph share the parsed values.
+    """
+    jsonFn = getInfoJsonFn(particlesFn)
+    if not os.path.exists(jsonFn):
+        return
+
+    mtime = os.path.getmtime(jsonFn)
+    if jsonFn not in cache or cache[jsonFn][0] != mtime:
+        jsonCtf = CTFModel()
+        readCTFModel(jsonCtf, jsonFn)
+        cache[jsonFn] = (mtime, jsonCtf)
+
+    jsonCtf = cache[jsonFn][1]
+    ctfModel.copyAttributes(jsonCtf, *[name for name in CTF_JSON_ATTRS
+                                       if hasattr(ctfModel, name) and
+                                       getattr(jsonCtf, name).hasValue()])
+
+
+def ctfModelToEman(ctfModel, acquisition, samplingRate):
+    """ Return the EMAN2Ctf parameters of a CTFModel, as encoded by EMAN
+    in the info json files (same conversion done in e2converter.py).
+    """
+    defU = ctfModel.getDefocusU()
+    defV = ctfModel.getDefocusV()
+
+    return {"__class__": "EMAN2Ctf",
+            "defocus": (defU + defV) / 20000.0,
+            "dfang": ctfModel.getDefocusAngle(),
+            "dfdiff": (defU - defV) / 10000.0,
+            "voltage": acquisition.getVoltage(),
+            "cs": acquisition.getSphericalAberration(),
+            "ampcont": acquisition.getAmplitudeContrast() * 100.0,
+            "apix": samplingRate}
+
+
+def writeCtfInfo(stackParts, infoPath):
+    """ Write the CTF of each particles stack into its EMAN info json
+    file, so e2ctf.py can use the known defocus instead of fitting it.
+    Params:
+        stackParts: dict {stackFn: particle with the CTF of the stack}
+        infoPath: EMAN project info/ folder
+    """
+    pwutils.makePath(infoPath)
+
+    for stackFn, part in stackParts.iteritems():
+        jsonFn = os.path.join(infoPath,
+                              os.path.basename(getInfoJsonFn(stackFn)))
+        # a copy, the cached dict must not be modified
+        jsonDict = dict(loadJson(jsonFn)) if os.path.exists(jsonFn) else {}
+        jsonDict['ctf'] = [ctfModelToEman(part.getCTF(),
+                                          part.getAcquisition(),
+                                          part.getSamplingRate())]
+        writeJson(jsonDict, jsonFn)
+
+
+def getProjectCachePath(*paths):
+    """ Return a path inside the plugin cache folder of the Scipion
+    project, shared by all runs (protocols are run from the project folder).
+    """
+    return os.path.join('Tmp', 'eman2', *paths)
+
+
+def getStructureFactorKey(partSet, *params):
+    """ Return a key identifying the particles (including their box size)
+    and their CTF, used to cache the structure factor computed from them.
+    Params:
+        params: other values used in the computation (e.g. program args)
+    """
+    acq = partSet.getAcquisition()
+    md5 = hashlib.md5()
+    for value in [partSet.getFileName(), partSet.getSize(), partSet.getDim(),
+                  partSet.getSamplingRate(), acq.getVoltage(),
+                  acq.getSphericalAberration(),
+                  acq.getAmplitudeContrast()] + list(params):
+        md5.update(str(value))
+
+    if partSet.hasCTF():
+        for part in partSet.iterItems(orderBy='id'):
+            ctf = part.getCTF()
+            md5.update('%s %s %s' % (ctf.getDefocusU(), ctf.getDefocusV(),
+                                     ctf.getDefocusAngle()))
+
+    return md5.hexdigest()
+
+
+def linkStructureFactor(partSet, projectPath, key=None):
+    """ Copy the structure factor computed by EMAN for the same particles
+    (if they were produced inside an EMAN project folder, e.g. by
+    e2ctf_auto.py) into the given project folder. If not found there,
+    the one cached with the given key is used.
+    Returns True if the structure factor is available. Only the ones
+    computed in the project folder should be cached afterwards.
+    """
+    sfFn = os.path.join(projectPath, STRUCFAC)
+    if not os.path.exists(sfFn):
+        partFn = partSet.getFirstItem().getFileName()
+        # particles stacks are in the particles/ folder of the project
+        inputSfFn = os.path.join(os.path.dirname(os.path.dirname(partFn)),
+                                 STRUCFAC)
+        cachedSfFn = getProjectCachePath(STRUCFAC, '%s.txt' % key)
+        if os.path.exists(inputSfFn):
+            # a copy, the other run may be deleted or continued
+            pwutils.copyFile(inputSfFn, sfFn)
+        elif key is not None and os.path.exists(cachedSfFn):
+            print("Using cached structure factor: %s" % cachedSfFn)
+            pwutils.copyFile(cachedSfFn, sfFn)
+
+    return os.path.exists(sfFn)
+
+
+def cacheStructureFactor(projectPath, key):
+    """ Store the structure factor computed in the given project folder
+    in the project cache, so later runs with the same key can reuse it.
+    """
+    sfFn = os.path.join(projectPath, STRUCFAC)
+    cachedSfFn = getProjectCachePath(STRUCFAC, '%s.txt' % key)
+    if os.path.exists(sfFn) and not os.path.exists(cachedSfFn):
+        pwutils.makePath(os.path.dirname(cachedSfFn))
+        pwutils.copyFile(sfFn, cachedSfFn)
+
+
+def getConvNetKey(refSets, *params):
+    """ Return a key identifying the neural net picker trained with the
+    given reference sets (None if not used) and params (e.g. box and
+    particle size). The ids and locations of the references and the size
+    and mtime of their stacks are used, not the converted stacks, since
+    those change on every conversion.
+    """
+    md5 = hashlib.md5()
+    for refSet in refSets:
+        md5.update('set')
+        if refSet is not None:
+            stacks = set()
+            for ref in refSet.iterItems(orderBy='id'):
+                md5.update('%s %s %s' % ((ref.getObjId(),) +
+                                         ref.getLocation()))
+                stacks.add(ref.getFileName())
+            # the stacks may be rewritten at the same paths (e.g. if the
+            # run producing the references is executed again)
+            for stackFn in sorted(stacks):
+                if os.path.exists(stackFn):
+                    st = os.stat(stackFn)
+                    md5.update('%s %d %r' % (stackFn, st.st_size,
+                                             st.st_mtime))
+    for value in params:
+        md5.update(str(value))
+
+    return md5.hexdigest()
+
+
+def linkConvNet(projectPath, key):
+    """ Copy the neural net picker cached with the given key into the
+    project folder. Returns True if the trained network is available.
+    """
+    cacheDir = getProjectCachePath('convnet', key)
+    for fn in CONVNET_FILES:
+        netFn = os.path.join(projectPath, fn)
+        cachedFn = os.path.join(cacheDir, fn)
+        if not os.path.exists(netFn) and os.path.exists(cachedFn):
+            pwutils.copyFile(cachedFn, netFn)
+
+    return os.path.exists(os.path.join(projectPath, CONVNET_FILES[0]))
+
+
+def cacheConvNet(projectPath, key):
+    """ Store the neural net picker trained in the project folder in the
+    project cache, so later runs with the same key can reuse it.
+    """
+    cacheDir = getProjectCachePath('convnet', key)
+    pwutils.makePath(cacheDir)
+    for fn in CONVNET_FILES:
+        netFn = os.path.join(projectPath, fn)
+        if os.path.exists(netFn):
+            pwutils.copyFile(netFn, os.path.join(cacheDir, fn))
+
+
+def writePickingCandidates(infoJsonFn, candidatesFn):
+    """ Store the boxes of a micrograph info file with their picking
+    score as a (x, y, score) float32 array in a .npy file, so they can
+    be thresholded again without picking. Boxes without score get NaN.
+    """
+    boxes = []
+    if os.path.exists(infoJsonFn):
+        boxes = loadJson(infoJsonFn).get('boxes', [])
+    candidates = numpy.array([(b[0], b[1], b[3] if len(b) > 3 else numpy.nan)
+                              for b in boxes], dtype=numpy.float32)
+    numpy.save(candidatesFn, candidates.reshape(-1, 3))
+
+
+def writeThresholdedBoxes(candidatesFn, infoJsonFn, threshold, boxType):
+    """ Write as the boxes of a micrograph info file the stored candidates
+    with score above the threshold (or without score).
+    Returns the number of boxes written.
+    """
+    candidates = numpy.load(candidatesFn)
+    selected = candidates[~(candidates[:, 2] < threshold)]
+    # a copy, the cached dict must not be modified
+    jsonDict = dict(loadJson(infoJsonFn)) if os.path.exists(infoJsonFn) else {}
+    jsonDict['boxes'] = [[float(x), float(y), boxType, float(score)]
+                         for x, y, score in selected]
+    writeJson(jsonDict, infoJsonFn)
+
+    return len(selected)
+
+
 def readSetOfCoordinates(workDir, micSet, coordSet, invertY=False, newBoxer=False):
     """ Read from Eman .json files.
     Params:
@@ -114,24 +417,128 @@ def readSetOfCoordinates(workDir, micSet, coordSet, invertY=False, newBoxer=Fals
             name should be the same of the micrographs.
         coordSet: the SetOfCoordinates that will be populated.
     """
-    if newBoxer:
-        # read boxSize from info/project.json
-        jsonFnbase = pwutils.join(workDir, 'info', 'project.json')
-        jsonBoxDict = loadJson(jsonFnbase)
-        size = int(jsonBoxDict["global.boxsize"])
-    else:
-        # read boxSize from e2boxercache/base.json
-        jsonFnbase = pwutils.join(workDir, 'e2boxercache', 'base.json')
-        jsonBoxDict = loadJson(jsonFnbase)
-        size = int(jsonBoxDict["box_size"])
+    tracker = CoordinatesTracker(workDir, newBoxer)
+    tracker.readCoordinates(micSet, coordSet, invertY)
 
-    jsonFninfo = pwutils.join(workDir, 'info/')
 
-    for mic in micSet:
-        micBase = pwutils.removeBaseExt(mic.getFileName())
-        micPosFn = ''.join(glob.glob(jsonFninfo + '*' + micBase + '_info.json'))
-        readCoordinates(mic, micPosFn, coordSet, invertY)
-    coordSet.setBoxSize(size)
+class CoordinatesTracker(object):
+    """ Read the boxer coordinates of an EMAN project into a
+    SetOfCoordinates, remembering which micrograph info files were
+    already read (and their mtime). Streaming pickers keep one tracker
+    so each batch only parses the new or modified info files.
+    """
+    def __init__(self, workDir, newBoxer=False):
+        self._workDir = workDir
+        self._newBoxer = newBoxer
+        self._infoDir = pwutils.join(workDir, 'info')
+        self._boxSize = None
+        # {infoJsonFn: (mtime, number of boxes already read)}
+        self._readFiles = {}
+
+    def getBoxSize(self):
+        """ Box size stored by the boxer, read only once. """
+        if self._boxSize is None:
+            if self._newBoxer:
+                # read boxSize from info/project.json
+                jsonFnbase = pwutils.join(self._workDir, 'info', 'project.json')
+                self._boxSize = int(loadJson(jsonFnbase)["global.boxsize"])
+            else:
+                # read boxSize from e2boxercache/base.json
+                jsonFnbase = pwutils.join(self._workDir, 'e2boxercache',
+                                          'base.json')
+                self._boxSize = int(loadJson(jsonFnbase)["box_size"])
+        return self._boxSize
+
+    def readCoordinates(self, micSet, coordSet, invertY=False):
+        """ Append to coordSet the boxes of the given micrographs that
+        were not read before. Return the number of new coordinates.
+        """
+        size = self.getBoxSize()
+        infoIndex = getInfoIndex(self._infoDir)
+
+        count = 0
+        for mic in micSet:
+            micPosFn = infoIndex.get(pwutils.removeBaseExt(mic.getFileName()))
+            if micPosFn is None or not os.path.exists(micPosFn):
+                continue
+            mtime = os.path.getmtime(micPosFn)
+            lastMtime, lastCount = self._readFiles.get(micPosFn, (None, 0))
+            if mtime == lastMtime:
+                continue
+            boxes = loadJson(micPosFn).get("boxes", [])
+            # the boxer only appends boxes to a modified file
+            appendCoordinates(mic, boxes[lastCount:], coordSet, invertY)
+            self._readFiles[micPosFn] = (mtime, len(boxes))
+            count += max(len(boxes) - lastCount, 0)
+        coordSet.setBoxSize(size)
+
+        return count
+
+
+# Folders that EMAN does not put in front of the info file names
+# (see base_name in EMAN2.py), e.g. info/extra-mic_1_info.json is
+# the info file of extra/mic_1.mrc but micrographs/mic_1.mrc has
+# info/mic_1_info.json
+EMAN_BASE_DIRS = ['micrographs', 'movies', 'movieparticles', 'particles',
+                  'raw', 'sets', 'stacks', 'tiltseries', 'tomograms', 'info']
+
+# {infoDir: (mtime, scanTime, {micBase: infoJsonFn})}, kept between calls
+_infoIndexCache = {}
+
+
+def getInfoIndex(infoDir, force=False):
+    """ Return a dict {micBase: infoJsonFn} with the micrograph info files
+    in an EMAN info folder. The names prefixed with the micrograph folder
+    by EMAN (<dir>-<micBase>_info.json) are also indexed by the micBase
+    after each '-', the exact names taking precedence.
+    The folder is scanned again only if it was modified since the last
+    scan, or the scan was done within the mtime resolution of the folder
+    (files added right after it would be missed), or force is True.
+    """
+    if not os.path.exists(infoDir):
+        return {}
+
+    mtime = os.path.getmtime(infoDir)
+    cached = _infoIndexCache.get(infoDir)
+    if (cached is not None and cached[0] == mtime and
+            cached[1] > mtime + 1 and not force):
+        return cached[2]
+
+    scanTime = time.time()
+    suffix = '_info.json'
+    index = {}
+    exactNames = {}
+    for fn in os.listdir(infoDir):
+        if not fn.endswith(suffix):
+            continue
+        stem = fn[:-len(suffix)]
+        jsonFn = os.path.join(infoDir, fn)
+        exactNames[stem] = jsonFn
+        parts = stem.split('-')
+        for i in range(1, len(parts)):
+            index.setdefault('-'.join(parts[i:]), jsonFn)
+    index.update(exactNames)
+
+    _infoIndexCache[infoDir] = (mtime, scanTime, index)
+    return index
+
+
+def findMicInfoFile(infoDir, micFn):
+    """ Return the info json file of a micrograph in an EMAN info folder,
+    with or without the folder prefix added by EMAN, or None.
+    """
+    return getInfoIndex(infoDir).get(pwutils.removeBaseExt(micFn))
+
+
+def getMicInfoName(micFn):
+    """ Return the name of the info json file that EMAN uses for the
+    micrograph micFn (relative to the EMAN project folder).
+    """
+    micBase = pwutils.removeBaseExt(micFn).split('__')[0]
+    micDir = os.path.basename(os.path.dirname(os.path.normpath(micFn)))
+    if micDir and micDir not in ['.', '..'] + EMAN_BASE_DIRS:
+        micBase = '%s-%s' % (micDir, micBase)
+    return micBase + '_info.json'
 
 
 def readCoordinates(mic, fileName, coordsSet, invertY=False):
@@ -139,18 +546,26 @@ def readCoordinates(mic, fileName, coordsSet, invertY=False):
         jsonPosDict = loadJson(fileName)
 
         if jsonPosDict.has_key("boxes"):
-            boxes = jsonPosDict["boxes"]
+            appendCoordinates(mic, jsonPosDict["boxes"], coordsSet, invertY)
 
-            for box in boxes:
-                x, y = box[:2]
 
-                if invertY:
-                    y = mic.getYDim() - y
+def appendCoordinates(mic, boxes, coordsSet, invertY=False):
+    """ Append the (x, y, ...) boxes of a micrograph to coordsSet,
+    reusing a single Coordinate object for the inserts.
+    """
+    coord = Coordinate()
+    coord.setMicrograph(mic)
+    yDim = mic.getYDim() if invertY else None
 
-                coord = Coordinate()
-                coord.setPosition(x, y)
-                coord.setMicrograph(mic)
-                coordsSet.append(coord)
+    for box in boxes:
+        x, y = box[:2]
+
+        if invertY:
+            y = yDim - y
+
+        coord.setObjId(None)
+        coord.setPosition(x, y)
+        coordsSet.append(coord)
 
 
 def writeSetOfMicrographs(micSet, filename):
@@ -177,32 +592,143 @@ def writeSetOfMicrographs(micSet, filename):
 
 
 def readSetOfParticles(lstFile, partSet, copyOrLink, direc):
-    for index, fn in iterLstFile(lstFile):
-        item = Particle()
-        # set full path to particles stack file
-        abspath = os.path.abspath(lstFile)
-        fn = abspath.replace('sets/%s' % os.path.basename(lstFile), '') + fn
-        newFn = pwutils.join(direc, os.path.basename(fn))
-        if not pwutils.exists(newFn):
-            copyOrLink(fn, newFn)
-
-        item.setLocation(index, newFn)
+    indexes, fileIds, fileNames = LstFile(lstFile).readAll()
+    # set full path to particles stack files, each one copied only once
+    abspath = os.path.abspath(lstFile)
+    projectPath = abspath.replace('sets/%s' % os.path.basename(lstFile), '')
+    newFileNames = [pwutils.join(direc, os.path.basename(fn))
+                    for fn in fileNames]
+    pending = dict((newFn, projectPath + fn)
+                   for fn, newFn in zip(fileNames, newFileNames)
+                   if not pwutils.exists(newFn))
+    if pending:
+        pool = ThreadPool(min(IO_THREADS, len(pending)))
+        pool.map(lambda newFn: copyOrLink(pending[newFn], newFn), pending)
+        pool.close()
+
+    item = Particle()
+    for index, fileId in zip(indexes.tolist(), fileIds.tolist()):
+        item.setObjId(None)
+        item.setLocation(index, newFileNames[fileId])
         partSet.append(item)
 
 
+# formats that EMAN reads as image stacks (e.g. a .mrc is read as a volume)
+EMAN_STACK_EXTS = ['mrcs']
+
+
+def getMrcSamplingRate(filename):
+    """ Return the sampling rate stored in the header of an MRC file,
+    or None if it cannot be read.
+    """
+    with open(filename, 'rb') as f:
+        header = f.read(52)
+    if len(header) < 52:
+        return None
+    for endian in '<>':
+        # nx, ny, nz, mode, nxstart, nystart, nzstart, mx, my, mz
+        words = numpy.frombuffer(header[:40], dtype=endian + 'i4')
+        if 0 <= words[3] < 16 and words[7] > 0:
+            cella = numpy.frombuffer(header[40:52], dtype=endian + 'f4')
+            return float(cella[0]) / words[7]
+    return None
+
+
+def canUseInputStacks(partSet, alignType=None):
+    """ Return True if EMAN can read the particles from the input stacks
+    with the same metadata as in the set. EMAN takes the sampling rate,
+    CTF and orientation from the images header, so only MRC stacks with
+    the set sampling rate are used, and only if the CTF and alignment
+    do not need to be written.
+    """
+    if partSet.hasCTF() or (alignType not in [None, em.ALIGN_NONE] and
+                            partSet.getFirstItem().hasTransform()):
+        return False
+    samplingRate = partSet.getSamplingRate()
+    for fn in partSet.getFiles():
+        # Scipion format suffixes, e.g. particles.mrc:mrcs, are not known
+        # by EMAN
+        if ':' in fn or pwutils.getExt(fn)[1:] not in EMAN_STACK_EXTS:
+            return False
+        apix = getMrcSamplingRate(fn)
+        if apix is None or abs(apix - samplingRate) > 0.01 * samplingRate:
+            print("The sampling rate of %s (%s) does not match the one of "
+                  "the particles, converting them" % (fn, apix))
+            return False
+    return True
+
+
 def writeSetOfParticles(partSet, path, **kwargs):
     """ Convert the imgSet particles to .hdf files as expected by Eman.
     This function should be called from a current dir where
     the images in the set are available.
+    If infoPath is passed, the CTF of the particles is also written to
+    the info json file of each stack.
+    If phaseFlip is True, the phase-flipped __ctf_flip stacks are written
+    in the same pass (the unflipped ones only if keepUnflipped).
+    If setName is passed, the sets/<setName>.lst file (as produced by
+    e2buildsets.py) is written in the conversion order, and also the
+    sets/<setName>__ctf_flip.lst if phaseFlip or flipSet are True (the
+    latter when the flipped stacks will be produced by e2ctf.py).
+    If lstOnly is True and EMAN can read the input stacks with the same
+    metadata (see canUseInputStacks), no image is written: the .lst file
+    points to the input stacks. Otherwise the particles are converted.
+    If reuseStacks is True and all particles were already converted by
+    another run (with the same header metadata, see getHeaderKey), the
+    .lst files point to those stacks instead of writing new ones, and
+    True is returned. Their info files are copied into infoPath and the
+    structure factor too.
+    If a converted dict is passed, it is filled with the location of
+    the new stacks, to be registered (see registerConvertedStacks) once
+    they are final.
     """
     ext = pwutils.getExt(partSet.getFirstItem().getFileName())[1:]
-    if ext == 'hdf':
+    infoPath = kwargs.get('infoPath')
+    lstOnly = (kwargs.get('lstOnly', False) and
+               canUseInputStacks(partSet, kwargs.get('alignType')))
+    phaseFlip = (kwargs.get('phaseFlip', False) and partSet.hasCTF() and
+                 not lstOnly)
+    keepUnflipped = kwargs.get('keepUnflipped', True)
+    # first particle of each output stack, used to write the CTF info
+    stackParts = {}
+    # (index, stackFn[, comment]) of each particle, to write the .lst files
+    entries = []
+    reusedEntries = None
+    if kwargs.get('reuseStacks', False) and not lstOnly and ext != 'hdf':
+        reusedEntries = findConvertedStacks(
+            partSet, flip=phaseFlip or kwargs.get('flipSet', False),
+            alignType=kwargs.get('alignType'))
+
+    if lstOnly:
+        for i, part in iterParticlesByMic(partSet):
+            # the index in EMAN begins with 0
+            entries.append((max(part.getIndex() - 1, 0), part.getFileName()))
+        print("Written only the .lst file for %d particles" % len(entries))
+
+    elif reusedEntries is not None:
+        # the headers of the reused stacks have the current metadata
+        entries = reusedEntries
+        print("Reused the stacks of a previous conversion for %d particles"
+              % len(entries))
+        linkConvertedCtf(set(fn for _, fn in reusedEntries),
+                         os.path.dirname(path), infoPath)
+
+    elif ext == 'hdf' and not phaseFlip:
         # create links if input has hdf format
         for fn in partSet.getFiles():
             newFn = pwutils.removeBaseExt(fn).split('__ctf')[0] + '.hdf'
             newFn = pwutils.join(path, newFn)
             pwutils.createLink(fn, newFn)
             print("   %s -> %s" % (fn, newFn))
+
+        if (infoPath and partSet.hasCTF()) or kwargs.get('setName'):
+            for i, part in iterParticlesByMic(partSet):
+                newFn = pwutils.removeBaseExt(part.getFileName()).split('__ctf')[0]
+                newFn = pwutils.join(path, newFn + '.hdf')
+                if infoPath and part.hasCTF() and newFn not in stackParts:
+                    stackParts[newFn] = part.clone()
+                # the index in EMAN begins with 0
+                entries.append((max(part.getIndex() - 1, 0), newFn))
     else:
         firstCoord = partSet.getFirstItem().getCoordinate() or None
         hasMicName = False
@@ -211,6 +737,9 @@ def writeSetOfParticles(partSet, path, **kwargs):
 
         fileName = ""
         a = 0
+        stackSizes = {}
+        # {sourceFn: {sourceIndex: [stackFn, index, headerKey]}}
+        converted = kwargs.get('converted')
         proc = eman2.Plugin.createEmanProcess(args='write')
 
         for i, part in iterParticlesByMic(partSet):
@@ -248,11 +777,252 @@ def writeSetOfParticles(partSet, path, **kwargs):
                 else:
                     a = 1
             objDict['_index'] = int(objDict['_index'] - a)
+
+            hdfFn = objDict['hdfFn']
+            if infoPath and part.hasCTF() and hdfFn not in stackParts:
+                stackParts[hdfFn] = part.clone()
+
+            entries.append((stackSizes.get(hdfFn, 0), hdfFn))
+            stackSizes[hdfFn] = stackSizes.get(hdfFn, 0) + 1
+            if keepUnflipped and converted is not None:
+                srcDict = converted.setdefault(part.getFileName(), {})
+                srcDict[str(part.getIndex())] = [os.path.abspath(hdfFn),
+                                                 entries[-1][0],
+                                                 getHeaderKey(part,
+                                                              alignType)]
+
+            if phaseFlip:
+                objDict['flipFn'] = pwutils.removeExt(hdfFn) + '__ctf_flip.hdf'
+                if not keepUnflipped:
+                    objDict['hdfFn'] = None
+
             # Write the e2converter.py process from where to read the image
             print >> proc.stdin, json.dumps(objDict)
             proc.stdin.flush()
             proc.stdout.readline()
         proc.kill()
+        # entries of a previous conversion into the same stacks are invalid
+        unregisterConvertedStacks(stackSizes.keys())
+
+    if stackParts and reusedEntries is None:
+        writeCtfInfo(stackParts, infoPath)
+
+    setName = kwargs.get('setName')
+    if setName:
+        # paths in the .lst files are relative to the EMAN project folder
+        projectPath = os.path.dirname(path)
+        setsPath = os.path.join(projectPath, 'sets')
+        pwutils.makePath(setsPath)
+        lstEntries = [(entry[0], os.path.relpath(entry[1], projectPath)) +
+                      tuple(entry[2:]) for entry in entries]
+
+        if keepUnflipped or not phaseFlip:
+            writeLstFile(os.path.join(setsPath, '%s.lst' % setName),
+                         lstEntries)
+        if phaseFlip or kwargs.get('flipSet', False):
+            writeLstFile(os.path.join(setsPath, '%s__ctf_flip.lst' % setName),
+                         [(entry[0], pwutils.removeExt(entry[1]) +
+                           '__ctf_flip.hdf') for entry in lstEntries])
+
+    return reusedEntries is not None
+
+
+def getHeaderKey(part, alignType=em.ALIGN_NONE):
+    """ Return a string identifying the particle metadata written to its
+    image header (sampling rate, CTF and projection), so converted stacks
+    are only reused if their headers are up to date.
+    """
+    metadata = {'apix': part.getSamplingRate()}
+    if part.hasCTF():
+        metadata['ctf'] = ctfModelToEman(part.getCTF(), part.getAcquisition(),
+                                         part.getSamplingRate())
+    if alignType not in [None, em.ALIGN_NONE] and part.hasTransform():
+        shifts, angles = alignmentToRow(part.getTransform(), alignType)
+        metadata['xform.projection'] = angles.tolist() + shifts.tolist()
+
+    return hashlib.md5(json.dumps(metadata, sort_keys=True)).hexdigest()
+
+
+def _getConvertedCacheFn(sourceFn):
+    sourceKey = hashlib.md5(os.path.abspath(sourceFn)).hexdigest()
+    return getProjectCachePath('converted', '%s.json' % sourceKey)
+
+
+def _getConvertedIndexFn():
+    """ Registry index: {stackFn: {'stamp': stamp, 'sources': [sourceFn]}}
+    with the stamp of each stack when it was registered and the source
+    files whose particles were converted into it.
+    """
+    return getProjectCachePath('converted', 'stacks.json')
+
+
+def getStackStamp(stackFn):
+    """ Return a string with the size and modification time of the
+    given stack and its __ctf_flip stack (if it exists), used to detect
+    if the stacks were modified after being registered.
+    """
+    stamps = []
+    for fn in [stackFn, pwutils.removeExt(stackFn) + '__ctf_flip.hdf']:
+        if os.path.exists(fn):
+            st = os.stat(fn)
+            stamps.append('%d:%r' % (st.st_size, st.st_mtime))
+        else:
+            stamps.append('')
+    return ' '.join(stamps)
+
+
+# Serialize the updates of the registry between threads of this process,
+# the file lock does it between processes
+_convertedLock = threading.Lock()
+
+
+@contextlib.contextmanager
+def _lockConvertedRegistry():
+    lockFn = getProjectCachePath('converted', '.lock')
+    pwutils.makePath(os.path.dirname(lockFn))
+    with _convertedLock:
+        with open(lockFn, 'a') as lockFile:
+            fcntl.flock(lockFile, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lockFile, fcntl.LOCK_UN)
+
+
+def _loadRegistryJson(jsonFn):
+    return loadJson(jsonFn) if os.path.exists(jsonFn) else {}
+
+
+def _dropConvertedStacks(stackFns, index):
+    """ Remove the entries of the given stacks from the registry files
+    (the lock must be held). The index dict is modified but not written.
+    """
+    sources = {}
+    for stackFn in stackFns:
+        for sourceFn in index.pop(stackFn, {}).get('sources', []):
+            sources.setdefault(sourceFn, set()).add(stackFn)
+
+    for sourceFn, dropped in sources.iteritems():
+        cacheFn = _getConvertedCacheFn(sourceFn)
+        sourceDict = _loadRegistryJson(cacheFn)
+        sourceDict = {k: row for k, row in sourceDict.iteritems()
+                      if row[0] not in dropped}
+        if sourceDict:
+            writeJson(sourceDict, cacheFn)
+        elif os.path.exists(cacheFn):
+            os.remove(cacheFn)
+
+
+def unregisterConvertedStacks(stackFns):
+    """ Remove from the registry all the entries pointing to the given
+    stacks, e.g. because they are going to be written again.
+    """
+    stackFns = set(os.path.abspath(fn) for fn in stackFns)
+    with _lockConvertedRegistry():
+        indexFn = _getConvertedIndexFn()
+        index = _loadRegistryJson(indexFn)
+        if stackFns.intersection(index):
+            index = dict(index)
+            _dropConvertedStacks(stackFns, index)
+            writeJson(index, indexFn)
+
+
+def registerConvertedStacks(converted):
+    """ Store in the project cache where the particles of each source
+    stack were converted, so other runs can reuse the EMAN stacks.
+    It should be called once the stacks are final (i.e. after e2ctf.py),
+    their current size and modification time are stored to detect
+    later changes. Previous entries of the same stacks are dropped.
+    Params:
+        converted: {sourceFn: {sourceIndex: [stackFn, index, headerKey]}}
+    """
+    stackSources = {}
+    for sourceFn, sourceDict in converted.iteritems():
+        for row in sourceDict.itervalues():
+            stackSources.setdefault(row[0], set()).add(sourceFn)
+
+    with _lockConvertedRegistry():
+        indexFn = _getConvertedIndexFn()
+        index = dict(_loadRegistryJson(indexFn))
+        _dropConvertedStacks(stackSources, index)
+
+        for sourceFn, sourceDict in converted.iteritems():
+            cacheFn = _getConvertedCacheFn(sourceFn)
+            cachedDict = dict(_loadRegistryJson(cacheFn))
+            cachedDict.update(sourceDict)
+            writeJson(cachedDict, cacheFn)
+
+        for stackFn, sources in stackSources.iteritems():
+            index[stackFn] = {'stamp': getStackStamp(stackFn),
+                              'sources': sorted(sources)}
+        writeJson(index, indexFn)
+
+
+def findConvertedStacks(partSet, flip=False, alignType=None):
+    """ Find the EMAN stacks where all particles were already converted
+    with the same header metadata (see registerConvertedStacks).
+    Params:
+        flip: the phase-flipped stacks must also exist.
+        alignType: alignment written to the headers (see getHeaderKey).
+    Return a list of (index, stackFn) in the conversion order,
+    or None if any particle was not found or its stack was modified.
+    """
+    index = _loadRegistryJson(_getConvertedIndexFn())
+    cache = {}
+    entries = []
+    valid = {}
+
+    def _isValid(stackFn):
+        if stackFn not in valid:
+            stamp = index.get(stackFn, {}).get('stamp')
+            valid[stackFn] = bool(stamp is not None and
+                                  stamp == getStackStamp(stackFn) and
+                                  (not flip or stamp.split(' ')[1]))
+        return valid[stackFn]
+
+    for i, part in iterParticlesByMic(partSet):
+        sourceFn = part.getFileName()
+        if sourceFn not in cache:
+            cache[sourceFn] = _loadRegistryJson(_getConvertedCacheFn(sourceFn))
+        row = cache[sourceFn].get(str(part.getIndex()))
+        if (row is None or row[2] != getHeaderKey(part, alignType) or
+                not _isValid(row[0])):
+            return None
+        entries.append((row[1], row[0]))
+
+    return entries
+
+
+def linkConvertedCtf(stackFns, projectPath, infoPath=None):
+    """ Copy the info json files (with the CTF and SNR computed by
+    e2ctf.py) of the given registered stacks into infoPath, and the
+    structure factor of their EMAN project into projectPath.
+    Returns True if the structure factor is available.
+    """
+    sfFn = os.path.join(projectPath, STRUCFAC)
+    for stackFn in stackFns:
+        # registered stacks are in the particles/ folder of their project
+        stackProject = os.path.dirname(os.path.dirname(stackFn))
+        if infoPath:
+            pwutils.makePath(infoPath)
+            jsonName = os.path.basename(getInfoJsonFn(stackFn))
+            jsonFn = os.path.join(stackProject, 'info', jsonName)
+            if os.path.exists(jsonFn):
+                pwutils.copyFile(jsonFn, os.path.join(infoPath, jsonName))
+        stackSfFn = os.path.join(stackProject, STRUCFAC)
+        if not os.path.exists(sfFn) and os.path.exists(stackSfFn):
+            pwutils.copyFile(stackSfFn, sfFn)
+
+    return os.path.exists(sfFn)
+
+
+def updateStacksCtf(stackFiles, cwd='.'):
+    """ Copy the CTF from the info json files (e.g. the SNR computed by
+    e2ctf.py) to the headers of the particles in the given stacks.
+    """
+    proc = eman2.Plugin.createEmanProcess(args='ctf %s' % ' '.join(stackFiles),
+                                          direc=cwd)
+    proc.wait()
 
 
 def getImageDimensions(imageFile):
@@ -286,13 +1056,155 @@ def convertImage(inputLoc, outputLoc):
     proc.wait()
 
 
+class LstFile(object):
+    """ Reader of EMAN .lst files.
+    In the fast LST format (LSX) all lines have the same length, so any
+    entry can be read by seeking to it and the whole file can be parsed
+    at once with numpy. Old .lst files are parsed line by line.
+    Returned indexes begin with 1, as in Scipion locations.
+    """
+    # number of lines parsed at once by readAll
+    CHUNK_LINES = 65536
+
+    def __init__(self, filename):
+        self._filename = filename
+        self._lineLen = None
+        self._entries = None  # only for non LSX files
+
+        f = open(filename, 'rb')
+        if f.readline().startswith('#LSX'):
+            f.readline()  # comment line
+            self._lineLen = int(f.readline()[1:])
+            self._seekBase = f.tell()
+            f.seek(0, os.SEEK_END)
+            self._size = (f.tell() - self._seekBase) // self._lineLen
+        else:
+            f.seek(0)
+            self._entries = []
+            for line in f:
+                if not line.startswith('#') and line.strip():
+                    values = line.split()
+                    self._entries.append((int(values[0]) + 1, values[1]))
+            self._size = len(self._entries)
+        f.close()
+
+    def __len__(self):
+        return self._size
+
+    def read(self, n):
+        """ Return the (index, filename) of the entry n (0-based). """
+        if not 0 <= n < self._size:
+            raise IndexError("Entry %d out of range in %s"
+                             % (n, self._filename))
+        if self._entries is not None:
+            return self._entries[n]
+
+        f = open(self._filename, 'rb')
+        f.seek(self._seekBase + n * self._lineLen)
+        values = f.read(self._lineLen).split()
+        f.close()
+        return int(values[0]) + 1, values[1]
+
+    def readAll(self):
+        """ Read all entries at once.
+        Return a tuple (indexes, fileIds, fileNames), where indexes and
+        fileIds are numpy arrays with one value per entry and fileNames
+        is the list of distinct filenames, indexed by fileIds.
+        """
+        if self._entries is not None:
+            fileIdsDict = {}
+            fileIds = numpy.array([fileIdsDict.setdefault(fn, len(fileIdsDict))
+                                   for _, fn in self._entries],
+                                  dtype=numpy.int32)
+            fileNames = sorted(fileIdsDict, key=fileIdsDict.get)
+            indexes = numpy.array([index for index, _ in self._entries],
+                                  dtype=int)
+            return indexes, fileIds, fileNames
+
+        indexes = numpy.empty(self._size, dtype=numpy.int64)
+        fileIds = numpy.empty(self._size, dtype=numpy.int32)
+        fileIdsDict = {}
+        f = open(self._filename, 'rb')
+        f.seek(self._seekBase)
+        # parsed in chunks, to bound the memory used with large sets
+        for first in range(0, self._size, self.CHUNK_LINES):
+            n = min(self.CHUNK_LINES, self._size - first)
+            lines = numpy.frombuffer(f.read(n * self._lineLen),
+                                     dtype=numpy.uint8)
+            chunkIndexes, chunkIds, names = self._parseLines(
+                lines.reshape(n, self._lineLen))
+            indexes[first:first + n] = chunkIndexes
+            namesIds = numpy.array([fileIdsDict.setdefault(name,
+                                                           len(fileIdsDict))
+                                    for name in names], dtype=numpy.int32)
+            fileIds[first:first + n] = namesIds[chunkIds]
+        f.close()
+        fileNames = sorted(fileIdsDict, key=fileIdsDict.get)
+
+        return indexes, fileIds, fileNames
+
+    def _parseLines(self, lines):
+        """ Parse a 2D array with the bytes of LSX lines.
+        Return the indexes, the ids of the filenames and the filenames.
+        """
+        # lines are: index<TAB>filename[<TAB>comment], padded with spaces
+        isTab = lines == ord('\t')
+        firstTab = isTab.argmax(axis=1)[:, None]
+        # only the columns of the longest index are converted to integers
+        cols = numpy.arange(firstTab.max())
+        inIndex = cols < firstTab
+        digits = lines[:, :len(cols)].astype(numpy.int64) - ord('0')
+        powers = 10 ** numpy.where(inIndex, firstTab - 1 - cols, 0)
+        indexes = numpy.where(inIndex, digits * powers, 0).sum(axis=1) + 1
+
+        cols = numpy.arange(self._lineLen)
+        afterTab = isTab & (cols > firstTab)
+        secondTab = numpy.where(afterTab.any(axis=1), afterTab.argmax(axis=1),
+                                self._lineLen)[:, None]
+        inName = ((cols > firstTab) & (cols < secondTab) &
+                  (lines != ord(' ')) & (lines != ord('\n')))
+        names = numpy.ascontiguousarray(numpy.where(inName, lines, 0),
+                                        dtype=numpy.uint8)
+        rows = names.view(numpy.dtype((numpy.void, self._lineLen))).ravel()
+        uniqueRows, fileIds = numpy.unique(rows, return_inverse=True)
+        fileNames = [row.tostring().strip('\0') for row in
+                     uniqueRows.view(numpy.uint8).reshape(-1, self._lineLen)]
+
+        return indexes, fileIds, fileNames
+
+    def __iter__(self):
+        """ Iterate over the (index, filename) entries, the filename
+        strings are shared by all entries of the same file.
+        """
+        indexes, fileIds, fileNames = self.readAll()
+        for index, fileId in zip(indexes.tolist(), fileIds.tolist()):
+            yield index, fileNames[fileId]
+
+
 def iterLstFile(filename):
-    f = open(filename)
-    for line in f:
-        if '#' not in line:
-            # Decompose Eman filename
-            index, filename = int(line.split()[0]) + 1, line.split()[1]
-            yield (index, filename)
+    """ Iterate over the (index, filename) entries of an EMAN .lst file. """
+    return iter(LstFile(filename))
+
+
+def writeLstFile(filename, entries):
+    """ Write an EMAN fast LST file (LSX format).
+    Params:
+        entries: list of (index, filename[, comment]) tuples, the index
+            begins with 0 and the filename is relative to the EMAN project
+            folder. The optional comment must not contain tabs or newlines.
+    """
+    lines = ['\t'.join(['%d' % entry[0]] + list(entry[1:]))
+             for entry in entries]
+    # all lines must have the same length, including the newline
+    lineLen = max([len(line) for line in lines] or [0]) + 1
+
+    f = open(filename, 'w')
+    f.write('#LSX\n# This file is in fast LST format. All lines after the '
+            'next line have exactly the number of characters shown on the '
+            'next line. This MUST be preserved if editing.\n')
+    f.write('# %d\n' % lineLen)
+    for line in lines:
+        f.write(line.ljust(lineLen - 1) + '\n')
     f.close()
 
 
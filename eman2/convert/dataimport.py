@@ -26,12 +26,47 @@
 # *
 # **************************************************************************
 
+from multiprocessing.pool import ThreadPool
+
+import numpy
+
 import pyworkflow.utils as pwutils
 from pyworkflow.em.data import Coordinate, CTFModel
 from pyworkflow.em.data_tiltpairs import Angles
-from pyworkflow.em.metadata import (MetaData, MDL_XCOOR, MDL_YCOOR,
-                                    MDL_PICKING_PARTICLE_SIZE)
-from .convert import loadJson, readCTFModel, readSetOfParticles
+from .convert import (loadJson, readCTFModel, readSetOfParticles,
+                      IO_THREADS)
+
+
+def readBoxFile(fileName):
+    """ Return an (n, 3) array with the x, y and size columns of an
+    EMAN .box file, or None if the file can not be parsed.
+    """
+    try:
+        # an empty file is read with shape (0, 1)
+        return numpy.loadtxt(fileName, usecols=(0, 1, 2),
+                             ndmin=2).reshape(-1, 3)
+    except (ValueError, IndexError):
+        return None
+
+
+def readCoordinateFile(fileName):
+    """ Return an (n, 2) array with the particle centers of an EMAN .box
+    or .json coordinates file, or None if the file can not be parsed.
+    """
+    if fileName.endswith('.box'):
+        boxes = readBoxFile(fileName)
+        if boxes is None:
+            return None
+        # .box files store the bottom-left corner of the boxes
+        return boxes[:, :2] + boxes[:, 2:] / 2
+
+    try:
+        jsonPosDict = loadJson(fileName)
+    except ValueError:
+        return None
+    boxes = jsonPosDict.get("boxes") or jsonPosDict.get("boxes_rct") or []
+    return numpy.array([box[:2] for box in boxes],
+                       dtype=float).reshape(-1, 2)
 
 
 class EmanImport:
@@ -40,6 +75,12 @@ class EmanImport:
         self.protocol = protocol
         self._lstFile = lstFile
         self.copyOrLink = protocol.getCopyOrLink()
+        # {(coordsDir, ext): boxSize}
+        self._boxSizes = {}
+        # {fileName: AsyncResult} of the coordinate files being read
+        self._coordsResults = {}
+        self._coordsPool = None
+        self._coordsPrefetched = False
 
     def importAngles(self, fileName, addAngles):
         if pwutils.exists(fileName):
@@ -63,49 +104,84 @@ class EmanImport:
         if pwutils.exists(fileName):
             ext = pwutils.getExt(fileName)
 
-            if ext == ".json":
-                jsonPosDict = loadJson(fileName)
-                boxes = []
-
-                if jsonPosDict.has_key("boxes"):
-                    boxes = jsonPosDict["boxes"]
-                elif jsonPosDict.has_key("boxes_rct"):
-                    boxes = jsonPosDict["boxes_rct"]
-                if boxes:
-                    for box in boxes:
-                        x, y = box[:2]
-                        coord = Coordinate()
-                        coord.setPosition(x, y)
-                        addCoordinate(coord)
-
-            elif ext == ".box":
-                md = MetaData()
-                md.readPlain(fileName, "xcoor ycoor particleSize")
-                size = md.getValue(MDL_PICKING_PARTICLE_SIZE, md.firstObject())
-                if size is None:
-                    print(">>> WARNING: Error parsing coordinate file: %s" % fileName)
-                    print("             Skipping this file.")
-                else:
-                    half = size / 2
-                    for objId in md:
-                        x = md.getValue(MDL_XCOOR, objId)
-                        y = md.getValue(MDL_YCOOR, objId)
-                        coord = Coordinate()
-                        coord.setPosition(x + half, y + half)
-                        addCoordinate(coord)
-            else:
+            if ext not in ['.json', '.box']:
                 raise Exception('Unknown extension "%s" to import Eman coordinates' % ext)
 
+            coords = self._getCoordinates(fileName)
+            if coords is None:
+                print(">>> WARNING: Error parsing coordinate file: %s" % fileName)
+                print("             Skipping this file.")
+            else:
+                for x, y in coords.tolist():
+                    coord = Coordinate()
+                    coord.setPosition(x, y)
+                    addCoordinate(coord)
+
+    def _getCoordinates(self, fileName):
+        """ Return the particle centers of a coordinates file. The first
+        call starts reading all files of the import in a thread pool.
+        """
+        if fileName not in self._coordsResults:
+            self._readCoordinatesAsync(fileName)
+
+        try:
+            coords = self._coordsResults.pop(fileName).get()
+        finally:
+            if not self._coordsResults:
+                self._closeCoordinatesPool()
+
+        return coords
+
+    def _readCoordinatesAsync(self, fileName):
+        """ Read the given file in the thread pool. The first time, also
+        the other files of the import that will be requested, i.e. those
+        with a matching micrograph.
+        """
+        fileNames = [fileName]
+        if not self._coordsPrefetched and hasattr(self.protocol, 'iterFiles'):
+            self._coordsPrefetched = True
+            getMatchingMic = getattr(self.protocol, 'getMatchingMic', None)
+            if getMatchingMic is not None:
+                fileNames += [fn for fn, fileId in self.protocol.iterFiles()
+                              if fn != fileName and
+                              getMatchingMic(fn, fileId) is not None]
+
+        if self._coordsPool is None:
+            self._coordsPool = ThreadPool(IO_THREADS)
+        for fn in fileNames:
+            if fn.endswith('.json') or fn.endswith('.box'):
+                self._coordsResults[fn] = self._coordsPool.apply_async(
+                    readCoordinateFile, (fn,))
+
+    def _closeCoordinatesPool(self):
+        """ Stop the reading threads and drop the pending results. """
+        if self._coordsPool is not None:
+            self._coordsPool.terminate()
+            self._coordsPool = None
+        self._coordsResults.clear()
+
+    def __del__(self):
+        if hasattr(self, '_coordsPool'):
+            self._closeCoordinatesPool()
+
     def getBoxSize(self, coordFile):
         """ Try to infer the box size from the given coordinate file.
         In the case of .box files, the size is the 3rd column
         In the case of .json files, we will look for file
         e2boxercache/base.json
+        The size is read once for all files in the same folder.
         """
+        key = (pwutils.dirname(coordFile), pwutils.getExt(coordFile))
+        if key not in self._boxSizes:
+            self._boxSizes[key] = self._readBoxSize(coordFile)
+
+        return self._boxSizes[key]
+
+    def _readBoxSize(self, coordFile):
         if coordFile.endswith('.box'):
-            md = MetaData()
-            md.readPlain(coordFile, "xcoor ycoor particleSize")
-            return md.getValue(MDL_PICKING_PARTICLE_SIZE, md.firstObject())
+            boxes = readBoxFile(coordFile)
+            if boxes is not None and len(boxes):
+                return int(boxes[0, 2])
 
         elif coordFile.endswith('.json'):
             infoDir = pwutils.dirname(coordFile)
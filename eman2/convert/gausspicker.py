@@ -0,0 +1,228 @@
+# **************************************************************************
+# *
+# * Authors:     Grigory Sharov (gsharov@mrc-lmb.cam.ac.uk)
+# *
+# * MRC Laboratory of Molecular Biology (MRC-LMB)
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 2 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+
+"""
+In-process implementation of the Sparx gaussian picker: the micrographs
+are cross-correlated with a Gaussian blob and the peaks of the CCF with
+value between the lower and higher thresholds are picked.
+
+It can also be run as a script, writing the boxes to the info/ folder
+of the current directory like e2boxer_old.py --write_dbbox:
+    gausspicker.py --boxsize=128 --gauss_width=0.5 --thr_low=0.004
+                   --thr_hi=0.1 [--invert] [--variance] mic1.mrc mic2.mrc
+With --init, only the box size is stored in e2boxercache/base.json,
+where it is read from together with the boxes.
+"""
+
+import os
+import json
+
+import numpy
+
+
+class GaussianPicker(object):
+    """ Pick particles from the Gaussian CCF of the micrographs.
+
+    The images are normalized (ramp removed, zero mean, unit variance)
+    and correlated with a unit-sum Gaussian of sigma gaussWidth*boxSize/4,
+    as done by the Sparx picker. The CCF is computed from a Fourier
+    cropped spectrum, so it is evaluated on a downsampled grid, and the
+    micrographs with the same dimensions are transformed together.
+    Images are normalized in single precision.
+    """
+    def __init__(self, boxSize, gaussWidth=1.0, lowerThreshold=1.0,
+                 higherThreshold=30.0, useVarImg=False, doInvert=True,
+                 batchSize=8):
+        self.boxSize = boxSize
+        self.sigma = gaussWidth * boxSize / 4.
+        self.lowerThreshold = lowerThreshold
+        self.higherThreshold = higherThreshold
+        self.useVarImg = useVarImg
+        self.doInvert = doInvert
+        self.batchSize = batchSize
+        # the Gaussian is well sampled at this downsampling
+        self.shrink = max(int(self.sigma // 2), 1)
+
+    def pick(self, images):
+        """ Return a list with a (x, y, score) array of the picked
+        particles of each image (2D numpy arrays), in image pixels.
+        """
+        results = [None] * len(images)
+        byShape = {}
+        for i, image in enumerate(images):
+            byShape.setdefault(image.shape, []).append(i)
+
+        for shape, indexes in byShape.items():
+            for first in range(0, len(indexes), self.batchSize):
+                batch = indexes[first:first + self.batchSize]
+                stack = numpy.empty((len(batch),) + shape,
+                                    dtype=numpy.float32)
+                for j, i in enumerate(batch):
+                    stack[j] = self._normalize(images[i])
+                ccfs = self._computeCcfs(stack)
+                for i, ccf in zip(batch, ccfs):
+                    results[i] = self._findPeaks(ccf)
+
+        return results
+
+    def pickFiles(self, micFiles):
+        """ Pick the given micrograph files, yielding the picked particles
+        of each one. The files are read and picked one at a time, so only
+        one micrograph is kept in memory.
+        """
+        from pyworkflow.em.convert import ImageHandler
+        ih = ImageHandler()
+        for fn in micFiles:
+            yield self.pick([ih.read(fn).getData()])[0]
+
+    def _normalize(self, image):
+        # a float32 copy, modified in place
+        image = numpy.array(image, dtype=numpy.float32)
+        if self.doInvert:
+            numpy.negative(image, out=image)
+
+        # remove the linear ramp, fitted on a subsample of the pixels
+        ny, nx = image.shape
+        y, x = numpy.mgrid[0:ny:4, 0:nx:4]
+        a = numpy.column_stack([x.ravel(), y.ravel(), numpy.ones(x.size)])
+        coefs = numpy.linalg.lstsq(a, image[::4, ::4].ravel(), rcond=-1)[0]
+        y, x = numpy.ogrid[0:ny, 0:nx]
+        image -= (coefs[0] * x + coefs[2]).astype(numpy.float32)
+        image -= (coefs[1] * y).astype(numpy.float32)
+        image /= image.std() or 1.
+
+        if self.useVarImg:
+            # local variance, averaged by the Gaussian in the CCF
+            image **= 2
+            image -= image.mean()
+            image /= image.std() or 1.
+
+        return image
+
+    def _computeCcfs(self, stack):
+        """ CCF of a (n, ny, nx) stack with the Gaussian, sampled every
+        self.shrink pixels.
+        """
+        n, ny, nx = stack.shape
+        sy, sx = ny // self.shrink, nx // self.shrink
+        fft = numpy.fft.rfft2(stack)
+
+        # Fourier crop to the downsampled size
+        hy = sy // 2
+        cropped = numpy.concatenate([fft[:, :hy, :sx // 2 + 1],
+                                     fft[:, ny - (sy - hy):, :sx // 2 + 1]],
+                                    axis=1)
+        # Fourier transform of the unit-sum Gaussian, in full size pixels
+        ky = numpy.fft.fftfreq(sy)[:, None] / self.shrink
+        kx = numpy.fft.rfftfreq(sx)[None, :] / self.shrink
+        gauss = numpy.exp(-2 * (numpy.pi * self.sigma) ** 2 * (kx ** 2 + ky ** 2))
+        ccfs = numpy.fft.irfft2(cropped * gauss, s=(sy, sx))
+
+        return ccfs * (float(sy * sx) / (ny * nx))
+
+    def _findPeaks(self, ccf):
+        """ Local maxima of the CCF within the thresholds, at least half
+        a box apart and away from the borders.
+        """
+        radius = max(int((self.boxSize / 2 - 1) / self.shrink), 1)
+        localMax = _maxFilter(ccf, radius)
+        peaks = ((ccf == localMax) & (ccf > self.lowerThreshold) &
+                 (ccf < self.higherThreshold))
+        margin = int(numpy.ceil(self.boxSize / 2. / self.shrink))
+        peaks[:margin, :] = False
+        peaks[-margin:, :] = False
+        peaks[:, :margin] = False
+        peaks[:, -margin:] = False
+
+        y, x = numpy.nonzero(peaks)
+        scores = ccf[y, x]
+        order = numpy.argsort(-scores)
+
+        return numpy.column_stack([x[order] * self.shrink,
+                                   y[order] * self.shrink,
+                                   scores[order]])
+
+
+def _maxFilter(image, radius):
+    """ Maximum over a (2*radius+1) square window (separable). """
+    result = image
+    for axis in range(2):
+        src = numpy.swapaxes(result, 0, axis)
+        res = src.copy()
+        for s in range(1, radius + 1):
+            numpy.maximum(res[s:], src[:-s], out=res[s:])
+            numpy.maximum(res[:-s], src[s:], out=res[:-s])
+        result = numpy.swapaxes(res, 0, axis)
+
+    return result
+
+
+def writeBoxes(micFn, boxes, outputDir='.'):
+    """ Write the picked (x, y, score) boxes of a micrograph to its
+    EMAN info file, as done by the EMAN boxer.
+    """
+    infoDir = os.path.join(outputDir, 'info')
+    if not os.path.exists(infoDir):
+        os.makedirs(infoDir)
+    micBase = os.path.splitext(os.path.basename(micFn))[0]
+    infoFn = os.path.join(infoDir, '%s_info.json' % micBase)
+
+    jsonDict = {}
+    if os.path.exists(infoFn):
+        with open(infoFn) as f:
+            jsonDict = json.load(f)
+    jsonDict['boxes'] = [[float(x), float(y), 'gauss', float(score)]
+                         for x, y, score in boxes]
+    with open(infoFn, 'w') as f:
+        json.dump(jsonDict, f)
+
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('--boxsize', type=int, required=True)
+    parser.add_argument('--gauss_width', type=float, default=1.0)
+    parser.add_argument('--thr_low', type=float, default=1.0)
+    parser.add_argument('--thr_hi', type=float, default=30.0)
+    parser.add_argument('--invert', action='store_true')
+    parser.add_argument('--variance', action='store_true')
+    parser.add_argument('--init', action='store_true')
+    parser.add_argument('micrographs', nargs='*')
+    args = parser.parse_args()
+
+    if args.init:
+        if not os.path.exists('e2boxercache'):
+            os.makedirs('e2boxercache')
+        with open(os.path.join('e2boxercache', 'base.json'), 'w') as f:
+            json.dump({'box_size': args.boxsize}, f)
+
+    picker = GaussianPicker(args.boxsize, args.gauss_width, args.thr_low,
+                            args.thr_hi, useVarImg=args.variance,
+                            doInvert=args.invert)
+    for micFn, boxes in zip(args.micrographs,
+                            picker.pickFiles(args.micrographs)):
+        writeBoxes(micFn, boxes)
@@ -34,10 +34,42 @@ As parameters will receive the output filename for the hdf stack
 
 import os, sys
 import json
-import EMAN2 as eman
+
+if os.environ.get('EMAN2STANDIN'):
+    # NumPy/h5py replacement, to run the script without EMAN
+    import e2standin as eman
+else:
+    import EMAN2 as eman
 
 MODE_WRITE = 'write'
 MODE_READ = 'read'
+MODE_CTF = 'ctf'
+MODE_TRAIN = 'trainnet'
+
+
+# header values computed from the image data, not copied to the flipped one
+DATA_ATTRS = ['nx', 'ny', 'nz', 'minimum', 'maximum', 'mean', 'sigma',
+              'square_sum', 'mean_nonzero', 'sigma_nonzero', 'median',
+              'changecount', 'datatype', 'is_complex', 'is_complex_x',
+              'is_complex_ri', 'is_fftodd', 'is_fftpad']
+
+
+def phaseFlip(imageData, ctf):
+    """ Return the phase-flipped image, as done by e2ctf.py --phaseflip
+    (with its default edge normalization). The header is also copied.
+    """
+    normData = imageData.copy()
+    normData.process_inplace('normalize.edgemean')
+    fft = normData.do_fft()
+    flipData = fft.copy()
+    ctf.compute_2d_complex(flipData, eman.Ctf.CtfType.CTF_SIGN)
+    fft.mult(flipData)
+    outData = fft.do_ift()
+    for key, value in imageData.get_attr_dict().items():
+        if key not in DATA_ATTRS:
+            outData.set_attr(key, value)
+
+    return outData
 
 
 def writeParticles():
@@ -91,19 +123,55 @@ def writeParticles():
         if transformation is not None:
             imageData.set_attr('xform.projection', transformation)
 
-        outputFile = str(objDict['hdfFn'])
+        # flipFn is set to also write the phase-flipped particle,
+        # hdfFn may be empty if the unflipped one is not needed
+        outputFile = str(objDict.get('hdfFn') or objDict['flipFn'])
         if outputFile != fnHdf:
             i = 0
             fnHdf = outputFile
 
-        imageData.write_image(outputFile, i,
-                              eman.EMUtil.ImageType.IMAGE_HDF, False)
+        if objDict.get('hdfFn'):
+            imageData.write_image(str(objDict['hdfFn']), i,
+                                  eman.EMUtil.ImageType.IMAGE_HDF, False)
+        if objDict.get('flipFn'):
+            flipData = phaseFlip(imageData, imageData.get_attr('ctf'))
+            flipData.write_image(str(objDict['flipFn']), i,
+                                 eman.EMUtil.ImageType.IMAGE_HDF, False)
         i += 1
         print("OK") # it is necessary to add newline
         sys.stdout.flush()
         line = sys.stdin.readline()
 
 
+def updateCtf(stackFiles):
+    """ Store the CTF of the micrograph info json in the header
+    of all particles of the given stacks (only headers are written).
+    """
+    for stackFn in stackFiles:
+        ctf = eman.js_open_dict(eman.info_name(stackFn))['ctf'][0]
+        for i in range(eman.EMUtil.get_image_count(stackFn)):
+            imageData = eman.EMData(stackFn, i, True)
+            imageData.set_attr('ctf', ctf)
+            imageData.write_image(stackFn, i,
+                                  eman.EMUtil.ImageType.IMAGE_HDF, True)
+
+
+def trainNetwork(goodRefsFn, badRefsFn, bgRefsFn):
+    """ Train the e2boxer neural net picker with the given references,
+    as done by the Train button of the boxer GUI. The network files
+    are written in the current folder.
+    """
+    from e2boxer import boxerConvNet
+
+    class RefsWindow(object):
+        goodrefs = eman.EMData.read_images(goodRefsFn)
+        badrefs = eman.EMData.read_images(badRefsFn)
+        bgrefs = eman.EMData.read_images(bgRefsFn)
+
+    boxerConvNet.boxerwindow = RefsWindow()
+    boxerConvNet.do_training()
+
+
 def readParticles(inputParts, inputCls, inputClasses, outputTxt, alitype='3d'):
     imgs = eman.EMUtil.get_image_count(inputParts)
     clsClassDict = {}
@@ -238,6 +306,10 @@ if __name__ == '__main__':
             outputTxt = sys.argv[5]
             alitype = sys.argv[6]
             readParticles(inputParts, inputCls, inputClasses, outputTxt, alitype)
+        elif mode == MODE_CTF:
+            updateCtf(sys.argv[2:])
+        elif mode == MODE_TRAIN:
+            trainNetwork(*sys.argv[2:5])
         else:
             raise Exception("e2converter: Unknown mode '%s'" % mode)
     else:
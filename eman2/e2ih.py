@@ -33,7 +33,12 @@ This way should be deprecated when we read more formats.
 
 import os
 import sys
-import EMAN2 as eman
+
+if os.environ.get('EMAN2STANDIN'):
+    # NumPy/h5py replacement, to run the script without EMAN
+    import e2standin as eman
+else:
+    import EMAN2 as eman
 
 
 if __name__ == '__main__':
@@ -0,0 +1,548 @@
+# **************************************************************************
+# *
+# * Authors:     J.M. De la Rosa Trevin (delarosatrevin@scilifelab.se)
+# *
+# * Unidad de  Bioinformatica of Centro Nacional de Biotecnologia , CSIC
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 2 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+"""
+Pure-Python stand-in of the subset of the EMAN2 module used by the
+e2converter.py and e2ih.py scripts, backed by NumPy and h5py.
+
+It allows running and profiling the converter scripts without an EMAN
+installation, e.g. on synthetic data. The scripts use it instead of
+EMAN2 when the EMAN2STANDIN environment variable is set:
+    EMAN2STANDIN=1 python e2converter.py write < particles.json
+
+Only HDF (EMAN layout, MDF/images/<i>) and MRC/MRCS images are
+supported. The CTF and the Euler angles conventions follow EMAN, but
+the results are not meant to be bit-identical to EMAN.
+"""
+
+import os
+import json
+import math
+
+import numpy
+import h5py
+
+
+# =============================================================================
+# Images
+# =============================================================================
+
+class EMUtil(object):
+    class ImageType(object):
+        IMAGE_UNKNOWN = 0
+        IMAGE_MRC = 3
+        IMAGE_HDF = 20
+
+    @staticmethod
+    def get_image_count(filename):
+        return _getFormat(filename).count(_cleanFn(filename))
+
+
+class EMData(object):
+    """ Image (real or Fourier transformed) with its header attributes.
+    The data is a numpy array with shape (ny, nx) or (nz, ny, nx).
+    """
+    def __init__(self, filename=None, index=0, header_only=False):
+        self._data = None
+        self._attrs = {}
+        # shape of the real image, for Fourier transforms
+        self._realShape = None
+        if filename is not None:
+            self.read_image(filename, index, header_only)
+
+    @staticmethod
+    def read_images(filename):
+        return [EMData(filename, i)
+                for i in range(EMUtil.get_image_count(filename))]
+
+    def read_image(self, filename, index=0, header_only=False):
+        data, attrs = _getFormat(filename).read(_cleanFn(filename), index,
+                                                header_only)
+        self._data = data
+        self._attrs = attrs
+        self._realShape = None
+
+    def write_image(self, filename, index=0, imgtype=None, header_only=False):
+        fmt = _getFormat(filename)
+        filename = _cleanFn(filename)
+        if index < 0:
+            index = fmt.count(filename) if os.path.exists(filename) else 0
+        fmt.write(filename, index, self, header_only)
+
+    def numpy(self):
+        return self._data
+
+    def get_xsize(self):
+        return self._getShape()[2]
+
+    def get_ysize(self):
+        return self._getShape()[1]
+
+    def get_zsize(self):
+        return self._getShape()[0]
+
+    def has_attr(self, key):
+        return key in self._attrs or key in ('nx', 'ny', 'nz')
+
+    def get_attr(self, key):
+        if key in ('nx', 'ny', 'nz'):
+            return self.get_attr_dict()[key]
+        return self._attrs[key]
+
+    def set_attr(self, key, value):
+        self._attrs[key] = value
+
+    def get_attr_dict(self):
+        attrs = dict(self._attrs)
+        nz, ny, nx = self._getShape()
+        attrs.update(nx=nx, ny=ny, nz=nz)
+        return attrs
+
+    def copy(self):
+        other = EMData()
+        other._data = None if self._data is None else self._data.copy()
+        other._attrs = dict(self._attrs)
+        other._realShape = self._realShape
+        return other
+
+    def do_fft(self):
+        other = self.copy()
+        other._data = numpy.fft.rfftn(self._data)
+        other._realShape = self._data.shape
+        return other
+
+    def do_ift(self):
+        other = self.copy()
+        other._data = numpy.fft.irfftn(self._data, s=self._realShape)
+        other._data = other._data.astype(numpy.float32)
+        other._realShape = None
+        return other
+
+    def process_inplace(self, processor, params=None):
+        """ Only the normalize.edgemean processor is supported: the mean
+        of the edge pixels is set to 0 and the standard deviation to 1.
+        """
+        if processor != 'normalize.edgemean':
+            raise Exception("EMAN2 stand-in: unsupported processor '%s'"
+                            % processor)
+        data = self._data
+        edge = numpy.concatenate([data[0].ravel(), data[-1].ravel(),
+                                  data[1:-1, 0].ravel(),
+                                  data[1:-1, -1].ravel()])
+        self._data = ((data - edge.mean()) /
+                      (data.std() or 1.)).astype(numpy.float32)
+
+    def mult(self, other):
+        if isinstance(other, EMData):
+            other = other._data
+        self._data = self._data * other
+
+    def __getitem__(self, pos):
+        """ EMAN indexing: img[x, y] or img[x, y, z] """
+        return float(self._data[tuple(reversed(pos))])
+
+    def __setitem__(self, pos, value):
+        self._data[tuple(reversed(pos))] = value
+
+    def _getShape(self):
+        """ Return the real image (nz, ny, nx) """
+        if self._realShape is not None:
+            shape = self._realShape
+        elif self._data is not None:
+            shape = self._data.shape
+        else:
+            shape = (self._attrs.get('nz', 1), self._attrs.get('ny', 0),
+                     self._attrs.get('nx', 0))
+        return (1,) * (3 - len(shape)) + tuple(shape)
+
+
+class EMNumPy(object):
+    @staticmethod
+    def numpy2em(array):
+        image = EMData()
+        image._data = numpy.array(array, dtype=numpy.float32)
+        return image
+
+    @staticmethod
+    def em2numpy(image):
+        return image._data
+
+
+# =============================================================================
+# CTF
+# =============================================================================
+
+class Ctf(object):
+    class CtfType(object):
+        CTF_AMP = 0
+        CTF_SIGN = 1
+
+
+class EMAN2Ctf(object):
+    """ CTF parameters as stored by EMAN: defocus and dfdiff in microns
+    (underfocus positive), dfang in degrees, voltage in kV, cs in mm,
+    ampcont in % and apix in A/pixel.
+    """
+    PARAMS = ['defocus', 'dfdiff', 'dfang', 'bfactor', 'ampcont', 'voltage',
+              'cs', 'apix', 'dsbg', 'background', 'snr']
+
+    def __init__(self):
+        for key in self.PARAMS:
+            setattr(self, key, 0.0)
+        self.background = []
+        self.snr = []
+
+    def from_dict(self, ctfDict):
+        for key, value in ctfDict.items():
+            if key in self.PARAMS:
+                setattr(self, key, value)
+
+    def to_dict(self):
+        return dict((key, getattr(self, key)) for key in self.PARAMS)
+
+    def compute_2d_complex(self, image, ctfType):
+        """ Set the values of a Fourier transformed image to the CTF
+        (or its sign, for phase flipping).
+        """
+        ny, nx = image._realShape[-2:]
+        ky = numpy.fft.fftfreq(ny)[:, None]
+        kx = numpy.fft.rfftfreq(nx)[None, :]
+        s2 = (kx ** 2 + ky ** 2) / self.apix ** 2
+        angle = numpy.arctan2(ky, kx)
+
+        voltage = self.voltage * 1000.
+        wavelength = 12.2639 / math.sqrt(voltage + 0.97845e-6 * voltage ** 2)
+        defocus = 1e4 * (self.defocus + self.dfdiff / 2. *
+                         numpy.cos(2 * (angle - math.radians(self.dfang))))
+        gamma = (math.pi * wavelength * defocus * s2 -
+                 math.pi / 2 * self.cs * 1e7 * wavelength ** 3 * s2 ** 2)
+        amp = self.ampcont / 100.
+        ctf = math.sqrt(1 - amp ** 2) * numpy.sin(gamma) + amp * numpy.cos(gamma)
+
+        if ctfType == Ctf.CtfType.CTF_SIGN:
+            ctf = numpy.where(ctf < 0, -1., 1.)
+        image._data = ctf.astype(numpy.complex64)
+
+
+# =============================================================================
+# Transform
+# =============================================================================
+
+def _rotX(a):
+    c, s = math.cos(a), math.sin(a)
+    return numpy.array([[1, 0, 0], [0, c, s], [0, -s, c]])
+
+
+def _rotY(a):
+    c, s = math.cos(a), math.sin(a)
+    return numpy.array([[c, 0, -s], [0, 1, 0], [s, 0, c]])
+
+
+def _rotZ(a):
+    c, s = math.cos(a), math.sin(a)
+    return numpy.array([[c, s, 0], [-s, c, 0], [0, 0, 1]])
+
+
+class Transform(object):
+    """ Rotation, translation and mirror of an image, created from the
+    'spider' (phi, theta, psi), 'eman' (az, alt, phi) or '2d' (alpha)
+    Euler angles in degrees.
+    """
+    def __init__(self, params=None):
+        self._matrix = numpy.identity(3)
+        self._trans = numpy.zeros(3)
+        self._mirror = False
+        self._scale = 1.0
+        if params:
+            self.set_params(params)
+
+    def set_params(self, params):
+        params = dict(params)
+        t = params.get('type', 'eman')
+        rad = lambda key: math.radians(params.get(key, 0))
+
+        if t == 'spider':
+            self._matrix = _rotZ(rad('psi')).dot(_rotY(rad('theta'))).dot(
+                _rotZ(rad('phi')))
+        elif t == 'eman':
+            self._matrix = _rotZ(rad('phi')).dot(_rotX(rad('alt'))).dot(
+                _rotZ(rad('az')))
+        elif t == '2d':
+            self._matrix = _rotZ(rad('alpha'))
+        else:
+            raise Exception("Transform: unsupported type '%s'" % t)
+
+        self._trans = numpy.array([params.get('tx', 0), params.get('ty', 0),
+                                   params.get('tz', 0)], dtype=float)
+        self._mirror = bool(params.get('mirror', False))
+        self._scale = params.get('scale', 1.0)
+
+    def get_rotation(self, t='eman'):
+        m = self._matrix
+        deg = math.degrees
+        second = math.acos(max(-1., min(1., m[2, 2])))
+        singular = abs(math.sin(second)) < 1e-6
+
+        if t == 'spider':
+            if singular:
+                phi, psi = 0., math.atan2(m[0, 1], m[0, 0] if m[2, 2] > 0
+                                          else m[1, 1])
+            else:
+                phi = math.atan2(m[2, 1], m[2, 0])
+                psi = math.atan2(m[1, 2], -m[0, 2])
+            return {'type': 'spider', 'phi': deg(phi), 'theta': deg(second),
+                    'psi': deg(psi)}
+        elif t == 'eman':
+            if singular:
+                az, phi = math.atan2(m[0, 1], m[0, 0]), 0.
+            else:
+                az = math.atan2(m[2, 0], -m[2, 1])
+                phi = math.atan2(m[0, 2], m[1, 2])
+            return {'type': 'eman', 'az': deg(az), 'alt': deg(second),
+                    'phi': deg(phi)}
+        elif t == '2d':
+            return {'type': '2d', 'alpha': deg(math.atan2(m[0, 1], m[0, 0]))}
+        raise Exception("Transform: unsupported type '%s'" % t)
+
+    def get_trans(self):
+        return self._trans.tolist()
+
+    def get_mirror(self):
+        return self._mirror
+
+    def get_scale(self):
+        return self._scale
+
+    def inverse(self):
+        other = Transform()
+        other._matrix = self._matrix.T.copy()
+        other._trans = -self._matrix.T.dot(self._trans)
+        other._mirror = self._mirror
+        other._scale = 1. / self._scale
+        return other
+
+    def to_dict(self):
+        return {'matrix': self._matrix.ravel().tolist(),
+                'trans': self._trans.tolist(),
+                'mirror': self._mirror, 'scale': self._scale}
+
+    def from_dict(self, transDict):
+        self._matrix = numpy.array(transDict['matrix']).reshape(3, 3)
+        self._trans = numpy.array(transDict['trans'])
+        self._mirror = transDict['mirror']
+        self._scale = transDict['scale']
+
+
+# =============================================================================
+# Info files
+# =============================================================================
+
+def _jsonDefault(obj):
+    if isinstance(obj, (EMAN2Ctf, Transform)):
+        objDict = obj.to_dict()
+        objDict['__class__'] = obj.__class__.__name__
+        return objDict
+    raise TypeError(repr(obj))
+
+
+def _jsonObjectHook(objDict):
+    objClass = {'EMAN2Ctf': EMAN2Ctf,
+                'Transform': Transform}.get(objDict.get('__class__'))
+    if objClass is None:
+        return objDict
+    obj = objClass()
+    obj.from_dict(objDict)
+    return obj
+
+
+def base_name(path):
+    """ Micrograph name of an EMAN file, e.g. for particles/mic1__ctf_flip.hdf
+    it is mic1.
+    """
+    return os.path.splitext(os.path.basename(path))[0].split('__')[0]
+
+
+def info_name(path):
+    return os.path.join('info', '%s_info.json' % base_name(path))
+
+
+def js_open_dict(filename):
+    """ Return the (read-only) content of an EMAN json file. """
+    if not os.path.exists(filename):
+        return {}
+    with open(filename) as f:
+        return json.load(f, object_hook=_jsonObjectHook)
+
+
+# =============================================================================
+# File formats
+# =============================================================================
+
+def _cleanFn(filename):
+    """ Remove the format suffix, e.g. particles.mrc:mrcs """
+    return filename.split(':')[0]
+
+
+def _getFormat(filename):
+    name, ext = os.path.splitext(filename)
+    if ':' in ext:
+        ext = '.' + ext.split(':')[1]
+    if ext in ['.hdf', '.h5']:
+        return HdfFormat
+    if ext in ['.mrc', '.mrcs']:
+        return MrcFormat(stack=ext == '.mrcs')
+    raise Exception("EMAN2 stand-in: unsupported image format '%s'" % ext)
+
+
+class HdfFormat(object):
+    """ EMAN HDF5 layout: one group per image in MDF/images, with the
+    'image' dataset and the header as 'EMAN.<key>' attributes.
+    """
+    PREFIX = 'EMAN.'
+    JSON_PREFIX = 'json:'
+
+    @staticmethod
+    def count(filename):
+        with h5py.File(filename, 'r') as f:
+            return len(f['MDF/images']) if 'MDF/images' in f else 0
+
+    @classmethod
+    def read(cls, filename, index, header_only):
+        with h5py.File(filename, 'r') as f:
+            group = f['MDF/images/%d' % index]
+            attrs = dict((key[len(cls.PREFIX):], cls._decode(value))
+                         for key, value in group.attrs.items()
+                         if key.startswith(cls.PREFIX))
+            data = None if header_only else group['image'][()]
+
+        return data, attrs
+
+    @classmethod
+    def write(cls, filename, index, image, header_only):
+        with h5py.File(filename, 'a') as f:
+            group = f.require_group('MDF/images/%d' % index)
+            if not header_only:
+                if 'image' in group:
+                    del group['image']
+                group.create_dataset('image',
+                                     data=image._data.astype(numpy.float32))
+            for key in list(group.attrs.keys()):
+                del group.attrs[key]
+            for key, value in image.get_attr_dict().items():
+                if value is not None:
+                    group.attrs[cls.PREFIX + key] = cls._encode(value)
+
+    @classmethod
+    def _encode(cls, value):
+        if isinstance(value, (EMAN2Ctf, Transform, list, tuple, dict)):
+            return cls.JSON_PREFIX + json.dumps(value, default=_jsonDefault)
+        return value
+
+    @classmethod
+    def _decode(cls, value):
+        if isinstance(value, bytes) and not isinstance(value, str):
+            value = value.decode()
+        if isinstance(value, basestring) and value.startswith(cls.JSON_PREFIX):
+            return json.loads(value[len(cls.JSON_PREFIX):],
+                              object_hook=_jsonObjectHook)
+        if isinstance(value, numpy.generic):
+            return value.item()
+        return value
+
+
+class MrcFormat(object):
+    """ MRC images (mode 0, 1, 2 or 6), little endian. Files with .mrcs
+    extension are stacks of 2D images, otherwise a single image/volume.
+    """
+    HEADER_SIZE = 1024
+    MODES = {0: numpy.int8, 1: numpy.int16, 2: numpy.float32, 6: numpy.uint16}
+
+    def __init__(self, stack=False):
+        self.stack = stack
+
+    def _readHeader(self, f):
+        header = numpy.fromfile(f, dtype='<i4', count=256)
+        nx, ny, nz, mode = header[:4]
+        dtype = numpy.dtype(self.MODES[int(mode)]).newbyteorder('<')
+        offset = self.HEADER_SIZE + int(header[23])
+        mx = int(header[7])
+        apix = float(header[10:11].view('<f4')[0]) / mx if mx else 1.0
+        return int(nx), int(ny), int(nz), dtype, offset, apix
+
+    def count(self, filename):
+        if not self.stack:
+            return 1
+        with open(filename, 'rb') as f:
+            return self._readHeader(f)[2]
+
+    def read(self, filename, index, header_only):
+        with open(filename, 'rb') as f:
+            nx, ny, nz, dtype, offset, apix = self._readHeader(f)
+            attrs = {'apix_x': apix, 'apix_y': apix, 'apix_z': apix}
+            stack = self.stack or index > 0
+            shape = (ny, nx) if stack or nz == 1 else (nz, ny, nx)
+            attrs.update(nx=nx, ny=ny, nz=1 if len(shape) == 2 else nz)
+            if header_only:
+                return None, attrs
+            size = int(numpy.prod(shape))
+            f.seek(offset + index * size * dtype.itemsize)
+            data = numpy.fromfile(f, dtype=dtype, count=size)
+
+        return data.reshape(shape).astype(numpy.float32), attrs
+
+    def write(self, filename, index, image, header_only):
+        data = image._data.astype('<f4')
+        if header_only:
+            return
+        if not (self.stack and os.path.exists(filename)):
+            nz = 1 if data.ndim == 2 else data.shape[0]
+            with open(filename, 'wb') as f:
+                self._writeHeader(f, data, nz, image)
+                data.tofile(f)
+            return
+
+        with open(filename, 'r+b') as f:
+            nx, ny, nz, _, offset, _ = self._readHeader(f)
+            f.seek(offset + index * data.nbytes)
+            data.tofile(f)
+            if index >= nz:
+                f.seek(0)
+                self._writeHeader(f, data, index + 1, image)
+
+    def _writeHeader(self, f, data, nz, image):
+        ny, nx = data.shape[-2:]
+        apix = (image.get_attr('apix_x') if image.has_attr('apix_x')
+                else 1.0)
+        header = numpy.zeros(256, dtype='<i4')
+        floats = header.view('<f4')
+        header[:4] = [nx, ny, nz, 2]
+        header[7:10] = [nx, ny, nz]
+        floats[10:13] = [nx * apix, ny * apix, nz * apix]
+        floats[13:16] = 90.
+        header[16:19] = [1, 2, 3]
+        floats[19:22] = [data.min(), data.max(), data.mean()]
+        header[52] = numpy.frombuffer(b'MAP ', dtype='<i4')[0]
+        header[53] = numpy.frombuffer(b'\x44\x44\x00\x00', dtype='<i4')[0]
+        header.tofile(f)
@@ -0,0 +1,172 @@
+# **************************************************************************
+# *
+# *  Authors:     Grigory Sharov (gsharov@mrc-lmb.cam.ac.uk)
+# *
+# * MRC Laboratory of Molecular Biology (MRC-LMB)
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 2 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+
+import fcntl
+import os
+import shutil
+import sqlite3
+
+import pyworkflow.object as pwobj
+from pyworkflow.em.data import SetOfParticles, CTFModel
+from pyworkflow.em.convert import ImageHandler
+
+from eman2.convert import LstFile, updateCtfFromJson
+
+
+# sqlite property set once the particle rows have been written
+MATERIALIZED_KEY = 'lstMaterialized'
+
+
+def _getSqliteProperty(dbFn, key):
+    """ Return the value of a property of a set sqlite file, or None. """
+    conn = sqlite3.connect(dbFn)
+    try:
+        row = conn.execute('SELECT value FROM Properties WHERE key=?',
+                           (key,)).fetchone()
+    except sqlite3.OperationalError:  # no properties written yet
+        row = None
+    finally:
+        conn.close()
+    return row[0] if row else None
+
+
+class EmanSetOfParticlesLst(SetOfParticles):
+    """ SetOfParticles derived from a base set through an EMAN .lst file.
+
+    Only a pointer to the base set and the .lst file with the new particle
+    locations are stored (plus the set properties, e.g. sampling rate).
+    The particle rows are written to the set sqlite file the first time
+    they are requested, so sets that are never used downstream do not
+    cost any disk space.
+    """
+    def __init__(self, **kwargs):
+        SetOfParticles.__init__(self, **kwargs)
+        self._baseSet = pwobj.Pointer()
+        self._lstFile = pwobj.String()
+        self._skipMaterialize = False
+
+    def setBaseSet(self, basePointer, lstFile, size=None):
+        """ Define where the particles come from.
+        Params:
+            basePointer: pointer to the set of particles used as base,
+                iterated in the same order as the .lst entries.
+            lstFile: EMAN .lst file (inside a sets/ folder) with the
+                new locations of the base particles.
+            size: number of enabled particles in the base set,
+                it will be counted if not provided.
+        """
+        self._baseSet.copy(basePointer)
+        self._lstFile.set(lstFile)
+        if size is None:
+            size = len([p for p in self._baseSet.get().iterItems()
+                        if p.isEnabled()])
+        self._size.set(size)
+        # Read the dimensions from the first .lst entry, they are
+        # needed to compute the sampling rate before materializing
+        index, fn = LstFile(lstFile).read(0)
+        x, y, z, _ = ImageHandler().getDimensions((index, self._getLstPath(fn)))
+        self._firstDim.set((x, y, z))
+
+    def isMaterialized(self):
+        """ Return True if the particle rows are already in the sqlite.
+        The property is read from the file without loading the mapper,
+        that would set the size to the number of rows written.
+        """
+        if not self._baseSet.hasValue():
+            return True
+        setFn = self.getFileName()
+        if (os.path.exists(setFn) and
+                _getSqliteProperty(setFn, MATERIALIZED_KEY) == 'true'):
+            return True
+        if not os.path.exists(self._lstFile.get()):
+            raise Exception("Cannot read the particles of %s, the EMAN .lst "
+                            "file %s is missing."
+                            % (self.getFileName(), self._lstFile.get()))
+        return False
+
+    def materialize(self):
+        """ Write the particle rows from the base set and the .lst file.
+        Disabled base particles are skipped, but their .lst rows consumed.
+        The rows are written to a copy of the sqlite file that replaces it
+        at the end, holding a file lock so concurrent readers of the set
+        (e.g. in other processes) do not write them twice.
+        """
+        if self.isMaterialized():
+            return
+
+        setFn = self.getFileName()
+        with open(setFn + '.lock', 'a') as lockFile:
+            fcntl.flock(lockFile, fcntl.LOCK_EX)
+            try:
+                # reopen the file, it may have been replaced while waiting
+                self.close()
+                if self.isMaterialized():
+                    return
+                tmpFn = '%s.%d.tmp' % (setFn, os.getpid())
+                if os.path.exists(setFn):
+                    shutil.copyfile(setFn, tmpFn)
+                self._writeRows(self._MapperClass(tmpFn,
+                                                  self._loadClassesDict()))
+                self.close()
+                os.rename(tmpFn, setFn)
+            finally:
+                fcntl.flock(lockFile, fcntl.LOCK_UN)
+
+    def _writeRows(self, mapper):
+        ctfCache = {}
+        lstIter = iter(LstFile(self._lstFile.get()))
+
+        for part in self._baseSet.get().iterItems():
+            index, fn = next(lstIter)
+            if not part.isEnabled():
+                continue
+            fileName = self._getLstPath(fn)
+            part.setLocation(index, fileName)
+            if not part.hasCTF():
+                part.setCTF(CTFModel())
+            updateCtfFromJson(part.getCTF(), fileName, ctfCache)
+            mapper.insert(part)
+
+        mapper.setProperty(MATERIALIZED_KEY, 'true')
+        mapper.commit()
+        mapper.close()
+
+    def write(self, properties=True):
+        self._skipMaterialize = True
+        SetOfParticles.write(self, properties)
+        self._skipMaterialize = False
+
+    def _getMapper(self):
+        if not self._skipMaterialize:
+            self.materialize()
+        return SetOfParticles._getMapper(self)
+
+    def _getLstPath(self, fn):
+        """ Paths inside the .lst are relative to the EMAN project folder,
+        where the sets/ folder is.
+        """
+        lstDir = os.path.dirname(os.path.dirname(self._lstFile.get()))
+        return os.path.join(lstDir, fn)
@@ -0,0 +1,127 @@
+# **************************************************************************
+# *
+# * Authors:     Grigory Sharov (gsharov@mrc-lmb.cam.ac.uk)
+# *
+# * MRC Laboratory of Molecular Biology (MRC-LMB)
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 2 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+
+
+import os
+import shutil
+import threading
+from glob import glob
+
+from pyworkflow.protocol.params import IntParam, LEVEL_ADVANCED
+import pyworkflow.utils as pwutils
+
+
+class EmanPickingWorkers(object):
+    """ Mixin for the EMAN auto pickers to pick a batch of micrographs
+    with several concurrent e2boxer processes.
+
+    Each worker runs in a private folder (with a copy of the files the
+    boxer needs, see _getWorkerFiles), so the workers do not race on
+    the shared project files. The micrograph info files are moved to
+    the protocol info folder once all workers are done.
+    """
+    def _definePickingWorkersParams(self, form):
+        form.addParam('pickingWorkers', IntParam, default=1,
+                      expertLevel=LEVEL_ADVANCED,
+                      label='Concurrent pickers',
+                      help='Number of e2boxer processes picking different '
+                           'micrographs of a batch at the same time. The '
+                           'threads are split between them.')
+
+    def _runPickingWorkers(self, micList, pickFunc):
+        """ Pick micList with pickFunc(micList, workDir, threads),
+        splitting it between the concurrent workers.
+        """
+        workers = min(self.pickingWorkers.get(), len(micList))
+        threads = self.numberOfThreads.get()
+        if workers <= 1:
+            pickFunc(micList, self.getCoordsDir(), threads)
+            return
+
+        threads = max(threads // workers, 1)
+        errors = []
+
+        def runWorker(workerMics, workDir):
+            try:
+                pickFunc(workerMics, workDir, threads)
+            except Exception as e:
+                errors.append(e)
+
+        # batches may be picked in concurrent steps, each micrograph is
+        # only in one batch so the first one identifies the batch folders
+        batchId = micList[0].getObjId()
+        jobs = []
+        for i in range(workers):
+            workDir = self._prepareWorkerDir(batchId, i)
+            job = threading.Thread(target=runWorker,
+                                   args=(micList[i::workers], workDir))
+            job.start()
+            jobs.append((job, workDir))
+
+        for job, _ in jobs:
+            job.join()
+        if errors:
+            raise errors[0]
+
+        for _, workDir in jobs:
+            self._mergeWorkerDir(workDir)
+            pwutils.cleanPath(workDir)
+
+    def _getWorkerFiles(self):
+        """ Paths (relative to the coordinates folder) to copy into each
+        worker folder. Should be implemented in subclasses.
+        """
+        return []
+
+    def _prepareWorkerDir(self, batchId, workerId):
+        workDir = self._getTmpPath('picker_b%06d_%02d' % (batchId, workerId))
+        pwutils.cleanPath(workDir)
+        pwutils.makePath(os.path.join(workDir, 'info'))
+
+        for path in self._getWorkerFiles():
+            src = os.path.join(self.getCoordsDir(), path)
+            dst = os.path.join(workDir, path)
+            if os.path.isdir(src):
+                shutil.copytree(src, dst)
+            elif os.path.exists(src):
+                shutil.copy(src, dst)
+        return workDir
+
+    def _mergeWorkerDir(self, workDir):
+        """ Move the worker micrograph info files to the protocol folder. """
+        infoDir = os.path.join(self.getCoordsDir(), 'info')
+        pwutils.makePath(infoDir)
+
+        for fn in glob(os.path.join(workDir, 'info', '*_info.json')):
+            dst = os.path.join(infoDir, os.path.basename(fn))
+            pwutils.cleanPath(dst)
+            shutil.move(fn, dst)
+
+        # keep the boxer project settings if picking started in workers
+        projectFn = os.path.join(workDir, 'info', 'project.json')
+        if (os.path.exists(projectFn) and
+                not os.path.exists(os.path.join(infoDir, 'project.json'))):
+            shutil.copy(projectFn, infoDir)
@@ -27,16 +27,22 @@
 import os
 
 from pyworkflow.protocol.params import (IntParam, FloatParam,
-                                        EnumParam, PointerParam)
+                                        EnumParam, PointerParam,
+                                        LEVEL_ADVANCED)
 from pyworkflow.em.protocol import ProtParticlePickingAuto
-from pyworkflow.utils import makePath
+import pyworkflow.utils as pwutils
+from pyworkflow.utils import makePath, copyFile
 
 import eman2
-from eman2.convert import readSetOfCoordinates, convertReferences
+from eman2.convert import (CoordinatesTracker, convertReferences,
+                           getConvNetKey, linkConvNet, cacheConvNet,
+                           writePickingCandidates, writeThresholdedBoxes,
+                           findMicInfoFile, getMicInfoName)
 from eman2.constants import *
+from protocol_autopick_base import EmanPickingWorkers
 
 
-class EmanProtAutopick(ProtParticlePickingAuto):
+class EmanProtAutopick(ProtParticlePickingAuto, EmanPickingWorkers):
     """ Automated particle picker for SPA. Uses EMAN2 (versions 2.2+) e2boxer.py
     """
     _label = 'boxer auto'
@@ -82,31 +88,55 @@ class EmanProtAutopick(ProtParticlePickingAuto):
                            "boxer.")
         form.addParam('threshold', FloatParam, default='5.0',
                       label='Threshold')
+        form.addParam('candidatesThreshold', FloatParam, allowsNull=True,
+                      expertLevel=LEVEL_ADVANCED,
+                      label='Candidates threshold',
+                      help="If set, e2boxer picks with this (lower) threshold "
+                           "and only the candidates above *Threshold* are "
+                           "kept in the output. The candidates are stored "
+                           "with their score, so other thresholds can be "
+                           "tried with *Re-threshold from*.")
+        form.addParam('inputCandidates', PointerParam,
+                      pointerClass='EmanProtAutopick', allowsNull=True,
+                      expertLevel=LEVEL_ADVANCED,
+                      label='Re-threshold from',
+                      help="Previous boxer auto run on the same micrographs. "
+                           "Its stored candidates are filtered with the new "
+                           "threshold instead of running e2boxer again.")
 
         form.addSection('References')
         form.addParam('goodRefs', PointerParam,
                       pointerClass='SetOfAverages',
-                      important=True,
+                      important=True, allowsNull=True,
+                      condition='not inputCandidates',
                       label="Good references",
-                      help="Good particle references.")
+                      help="Good particle references. Not used when "
+                           "re-thresholding the candidates of a previous "
+                           "run.")
         form.addParam('badRefs', PointerParam,
                       pointerClass='SetOfAverages',
-                      allowsNull=True,
+                      allowsNull=True, condition='not inputCandidates',
                       label="Bad references",
                       help="Bad particle references like ice contamination "
                            "or large aggregation.")
         form.addParam('bgRefs', PointerParam,
                       pointerClass='SetOfAverages',
-                      allowsNull=True,
+                      allowsNull=True, condition='not inputCandidates',
                       label="Background references",
                       help="Pure noise regions in micrograph.")
 
+        self._definePickingWorkersParams(form)
         form.addParallelSection(threads=1, mpi=0)
 
     # --------------------------- INSERT steps functions ----------------------
     def _insertInitialSteps(self):
         self._createFilenameTemplates()
+        if self.inputCandidates.hasValue():
+            return [self._insertFunctionStep('copyBoxerSettingsStep')]
         initId = self._insertFunctionStep('convertInputStep')
+        if self.boxerMode.get() == AUTO_CONVNET:
+            initId = self._insertFunctionStep('trainNetworkStep',
+                                              prerequisites=[initId])
         return [initId]
 
     # --------------------------- STEPS functions -----------------------------
@@ -124,21 +154,83 @@ class EmanProtAutopick(ProtParticlePickingAuto):
             if refs is not None:
                 convertReferences(refs, output[i])
 
+    def copyBoxerSettingsStep(self):
+        """ Use the boxer settings of the run providing the candidates. """
+        makePath(self._getExtraPath('info'))
+        copyFile(self.inputCandidates.get()._getExtraPath('info',
+                                                          'project.json'),
+                 self._getExtraPath('info', 'project.json'))
+
+    def trainNetworkStep(self):
+        """ Train the neural net picker once for all micrographs. The
+        network is cached, so runs with the same references reuse it.
+        """
+        refSets = [ref.get() if ref.hasValue() else None
+                   for ref in [self.goodRefs, self.badRefs, self.bgRefs]]
+        key = getConvNetKey(refSets, self.boxSize.get(),
+                            self.particleSize.get())
+        coordsDir = self.getCoordsDir()
+        if linkConvNet(coordsDir, key):
+            self._log.info("Using cached neural net picker: %s" % key)
+            return
+
+        refFiles = [os.path.relpath(self._getFileName(k), coordsDir)
+                    for k in ['goodRefsFn', 'badRefsFn', 'bgRefsFn']]
+        program = eman2.Plugin.getProgram(
+            os.path.join(eman2.__path__[0], 'e2converter.py'), python=True)
+        self.runJob(program, 'trainnet %s' % ' '.join(refFiles),
+                    cwd=coordsDir, numberOfThreads=1)
+        cacheConvNet(coordsDir, key)
+
     def _pickMicrograph(self, mic, *args):
-        micFile = os.path.relpath(mic.getFileName(), self.getCoordsDir())
+        self._pickMicrographList([mic], *args)
+
+    def _pickMicrographList(self, micList, *args):
+        """ Pick all micrographs of a streaming batch with a single
+        e2boxer call, so the references and the picker are set up once.
+        The picked boxes are stored with their score as candidates.
+        """
+        if self.inputCandidates.hasValue():
+            self._pickFromCandidates(micList)
+            return
+
+        self._runPickingWorkers(micList, self._runBoxer)
+        makePath(self._getExtraPath('candidates'))
+        for mic in micList:
+            infoFn, candidatesFn = getPickingFiles(self, mic)
+            writePickingCandidates(infoFn, candidatesFn)
+            if self.candidatesThreshold.hasValue():
+                writeThresholdedBoxes(candidatesFn, infoFn,
+                                      self.threshold.get(),
+                                      self._getBoxerMode())
+
+    def _pickFromCandidates(self, micList):
+        """ Select the boxes from the candidates of a previous run. """
+        for mic in micList:
+            infoFn, _ = getPickingFiles(self, mic)
+            _, candidatesFn = getPickingFiles(self.inputCandidates.get(), mic)
+            if os.path.exists(candidatesFn):
+                writeThresholdedBoxes(candidatesFn, infoFn,
+                                      self.threshold.get(),
+                                      self._getBoxerMode())
+
+    def _runBoxer(self, micList, workDir, threads):
         params = " --apix=%f --no_ctf" % self.inputMicrographs.get().getSamplingRate()
         params += " --boxsize=%d" % self.boxSize.get()
         params += " --ptclsize=%d" % self.particleSize.get()
-        params += " --threads=%d" % self.numberOfThreads.get()
+        params += " --threads=%d" % threads
 
-        modes = ['auto_local', 'auto_ref', 'auto_gauss', 'auto_convnet']
-        params += " --autopick=%s:threshold=%0.2f" % (
-            modes[self.boxerMode.get()], self.threshold.get())
+        threshold = self.threshold.get()
+        if self.candidatesThreshold.hasValue():
+            threshold = self.candidatesThreshold.get()
+        params += " --autopick=%s:threshold=%0.2f" % (self._getBoxerMode(),
+                                                      threshold)
 
-        params += ' %s' % micFile
+        for mic in micList:
+            params += ' %s' % os.path.relpath(mic.getFileName(), workDir)
         program = eman2.Plugin.getBoxerCommand()
 
-        self.runJob(program, params, cwd=self.getCoordsDir())
+        self.runJob(program, params, cwd=workDir)
 
     def createOutputStep(self):
         pass
@@ -146,6 +238,11 @@ class EmanProtAutopick(ProtParticlePickingAuto):
     # --------------------------- INFO functions ------------------------------
     def _validate(self):
         errors = []
+        if self.inputCandidates.hasValue():
+            # the references were used by the run providing the candidates
+            return errors
+        if not self.goodRefs.hasValue():
+            errors.append('Good references are required.')
         if self.boxerMode.get() == AUTO_GAUSS:
             errors.append('Gauss mode is not implemented for new e2boxer yet.')
         if self.boxerMode.get() == AUTO_CONVNET:
@@ -158,10 +255,39 @@ class EmanProtAutopick(ProtParticlePickingAuto):
     def getCoordsDir(self):
         return self._getExtraPath()
 
+    def _getWorkerFiles(self):
+        return ['info/project.json', 'info/boxrefs.hdf',
+                'info/boxrefsbad.hdf', 'info/bgrefsbad.hdf'] + CONVNET_FILES
+
+    def _getBoxerMode(self):
+        modes = ['auto_local', 'auto_ref', 'auto_gauss', 'auto_convnet']
+        return modes[self.boxerMode.get()]
+
     def getFiles(self):
         return (self.inputMicrographs.get().getFiles() |
                 ProtParticlePickingAuto.getFiles(self))
 
     def readCoordsFromMics(self, workingDir, micList, coordSet):
+        # Keep the tracker between streaming batches, so only new or
+        # modified info files are parsed
+        tracker = getattr(self, '_coordsTracker', None)
+        if tracker is None:
+            tracker = CoordinatesTracker(workingDir, newBoxer=True)
+            self._coordsTracker = tracker
         coordSet.setBoxSize(self.boxSize.get())
-        readSetOfCoordinates(workingDir, micList, coordSet, newBoxer=True)
+        tracker.readCoordinates(micList, coordSet)
+
+
+def getPickingFiles(prot, mic):
+    """ Return the info json and the stored candidates files of a
+    micrograph picked by the given boxer auto run. If the info file does
+    not exist yet, the one EMAN would write is returned.
+    """
+    infoDir = prot._getExtraPath('info')
+    infoFn = findMicInfoFile(infoDir, mic.getFileName())
+    if infoFn is None:
+        # micrographs are passed to e2boxer relative to its project folder
+        micFn = os.path.relpath(mic.getFileName(), prot.getCoordsDir())
+        infoFn = os.path.join(infoDir, getMicInfoName(micFn))
+    micBase = pwutils.removeBaseExt(mic.getFileName())
+    return infoFn, prot._getExtraPath('candidates', '%s.npy' % micBase)
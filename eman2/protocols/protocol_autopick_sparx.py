@@ -28,15 +28,19 @@
 
 import os
 
-from pyworkflow.protocol.params import (IntParam, FloatParam,
+from pyworkflow.protocol.params import (IntParam, FloatParam, EnumParam,
                                         BooleanParam, LEVEL_ADVANCED)
+from pyworkflow.utils import makePath
 from pyworkflow.em.protocol import ProtParticlePickingAuto
 
 import eman2
-from eman2.convert import readSetOfCoordinates
+from eman2.convert import CoordinatesTracker, writeJson
+from eman2.convert.gausspicker import GaussianPicker, writeBoxes
+from eman2.constants import GAUSS_EMAN, GAUSS_NUMPY
+from protocol_autopick_base import EmanPickingWorkers
 
 
-class SparxGaussianProtPicking(ProtParticlePickingAuto):
+class SparxGaussianProtPicking(ProtParticlePickingAuto, EmanPickingWorkers):
     """
     Automated particle picker for SPA. Uses Sparx gaussian picker.
     For more information see http://sparx-em.org/sparxwiki/e2boxer
@@ -68,7 +72,16 @@ class SparxGaussianProtPicking(ProtParticlePickingAuto):
                       expertLevel=LEVEL_ADVANCED,
                       label='Invert contrast?',
                       help='Picker expects particles to be white.')
+        form.addParam('pickerEngine', EnumParam, default=GAUSS_EMAN,
+                      choices=['EMAN', 'NumPy'],
+                      display=EnumParam.DISPLAY_HLIST,
+                      expertLevel=LEVEL_ADVANCED,
+                      label='Picker engine',
+                      help='_EMAN_ runs the Sparx picker of e2boxer_old.py. '
+                           '_NumPy_ runs an equivalent picker inside Scipion, '
+                           'computing the CCF of downsampled micrographs.')
 
+        self._definePickingWorkersParams(form)
         form.addParallelSection(threads=1, mpi=0)
 
     # --------------------------- INSERT steps functions ----------------------
@@ -90,6 +103,13 @@ class SparxGaussianProtPicking(ProtParticlePickingAuto):
                 "useVarImg": "true" if useVarImg else "false",
                 "doInvert": "true" if doInvert else "false",
                 "extraParams": self.extraParams}
+        if self.pickerEngine.get() == GAUSS_NUMPY:
+            # only the box size is needed to read the coordinates
+            makePath(self._getExtraPath('e2boxercache'))
+            writeJson({'box_size': boxSize},
+                      self._getExtraPath('e2boxercache', 'base.json'))
+            return
+
         params = 'demoparms --makedb=thr_low=%(lowerThreshold)s:'
         params += 'thr_hi=%(higherThreshold)s:boxsize=%(boxSize)s:'
         params += 'invert_contrast=%(doInvert)s:use_variance=%(useVarImg)s:'
@@ -100,12 +120,32 @@ class SparxGaussianProtPicking(ProtParticlePickingAuto):
                     numberOfThreads=1)
 
     def _pickMicrograph(self, mic, *args):
-        micFile = os.path.relpath(mic.getFileName(), self.getCoordsDir())
+        self._pickMicrographList([mic], *args)
+
+    def _pickMicrographList(self, micList, *args):
+        """ Pick all micrographs of a streaming batch with one e2boxer call. """
+        self._runPickingWorkers(micList, self._runBoxer)
+
+    def _runBoxer(self, micList, workDir, threads):
+        if self.pickerEngine.get() == GAUSS_NUMPY:
+            picker = GaussianPicker(self.boxSize.get(), self.gaussWidth.get(),
+                                    self.lowerThreshold.get(),
+                                    self.higherThreshold.get(),
+                                    useVarImg=self.useVarImg.get(),
+                                    doInvert=self.doInvert.get())
+            micFiles = [mic.getFileName() for mic in micList]
+            for micFn, boxes in zip(micFiles, picker.pickFiles(micFiles)):
+                writeBoxes(micFn, boxes, workDir)
+            return
+
+        # the old boxer does not use threads
+        micFiles = [os.path.relpath(mic.getFileName(), workDir)
+                    for mic in micList]
         params = ('--gauss_autoboxer=demoparms --write_dbbox --boxsize=%d %s'
-                  % (self.boxSize, micFile))
+                  % (self.boxSize, ' '.join(micFiles)))
         program = eman2.Plugin.getBoxerCommand(boxerVersion='old')
 
-        self.runJob(program, params, cwd=self.getCoordsDir())
+        self.runJob(program, params, cwd=workDir)
 
     def createOutputStep(self):
         pass
@@ -119,10 +159,20 @@ class SparxGaussianProtPicking(ProtParticlePickingAuto):
     def getCoordsDir(self):
         return self._getExtraPath()
 
+    def _getWorkerFiles(self):
+        # the gaussian picker parameters db written by initSparxDb
+        return ['e2boxercache']
+
     def getFiles(self):
         return (self.inputMicrographs.get().getFiles() |
                 ProtParticlePickingAuto.getFiles(self))
 
     def readCoordsFromMics(self, workingDir, micList, coordSet):
+        # Keep the tracker between streaming batches, so only new or
+        # modified info files are parsed
+        tracker = getattr(self, '_coordsTracker', None)
+        if tracker is None:
+            tracker = CoordinatesTracker(workingDir, newBoxer=False)
+            self._coordsTracker = tracker
         coordSet.setBoxSize(self.boxSize.get())
-        readSetOfCoordinates(workingDir, micList, coordSet, newBoxer=False)
+        tracker.readCoordinates(micList, coordSet)
@@ -27,16 +27,19 @@
 # **************************************************************************
 
 import os
+from glob import glob
 
 from pyworkflow.object import String
 from pyworkflow.utils.properties import Message
 from pyworkflow.utils.path import join, getExt
 from pyworkflow.gui.dialog import askYesNo
+from pyworkflow.em.data import SetOfCoordinates
 from pyworkflow.em.protocol import ProtParticlePicking
 from pyworkflow.protocol.params import BooleanParam, IntParam
 
 import eman2
-from eman2.convert import loadJson, readSetOfCoordinates
+from eman2.convert import (loadJson, writeJson, readSetOfCoordinates,
+                           CoordinatesTracker, findMicInfoFile)
 
 
 class EmanProtBoxing(ProtParticlePicking):
@@ -196,8 +199,75 @@ class EmanProtBoxing(ProtParticlePicking):
         return filePaths
 
     def readSetOfCoordinates(self, workingDir, coordSet):
-        readSetOfCoordinates(workingDir, self.inputMics, coordSet,
-                             self.invertY.get(), newBoxer=self._useNewBoxer())
+        infoMtimes = self._getInfoMtimes(join(workingDir, 'info'))
+        prevSet = self._getLastCoordinates()
+        prevMtimes = None
+        if prevSet is not None:
+            prevMtimes = self._loadOutputMtimes().get(
+                os.path.basename(prevSet.getFileName()))
+
+        if prevMtimes is None:
+            readSetOfCoordinates(workingDir, self.inputMics, coordSet,
+                                 self.invertY.get(),
+                                 newBoxer=self._useNewBoxer())
+        else:
+            # Copy the coordinates of the micrographs not modified since
+            # the previous output was created, read the others
+            # (micrographs without info file now are read, i.e. cleared)
+            changed = set(fn for fn in set(infoMtimes) | set(prevMtimes)
+                          if infoMtimes.get(fn) != prevMtimes.get(fn))
+            infoDir = join(workingDir, 'info')
+            changedMics = []
+            for mic in self.inputMics:
+                infoFn = findMicInfoFile(infoDir, mic.getFileName())
+                if infoFn is None or os.path.basename(infoFn) in changed:
+                    changedMics.append(mic.clone())
+            changedIds = set(mic.getObjId() for mic in changedMics)
+
+            for coord in prevSet.iterItems():
+                if coord.getMicId() not in changedIds:
+                    coord.setObjId(None)
+                    coordSet.append(coord)
+
+            tracker = CoordinatesTracker(workingDir, self._useNewBoxer())
+            tracker.readCoordinates(changedMics, coordSet, self.invertY.get())
+
+        self._saveOutputMtimes(os.path.basename(coordSet.getFileName()),
+                               infoMtimes)
+
+    def _getLastCoordinates(self):
+        """ Return the output coordinates of the previous session, i.e.
+        the outputCoordinatesN with the highest N (no suffix for the first).
+        """
+        lastSet = None
+        lastNumber = 0
+        for attrName, coordSet in self.iterOutputAttributes(SetOfCoordinates):
+            suffix = attrName[len('outputCoordinates'):]
+            number = int(suffix) if suffix.isdigit() else 1
+            if number > lastNumber:
+                lastSet, lastNumber = coordSet, number
+        return lastSet
+
+    def _getInfoMtimes(self, infoDir):
+        """ Return a dict {infoJsonName: mtime} of the micrographs. """
+        # the mtime is stored as a string to compare it exactly once saved
+        return dict((os.path.basename(fn), repr(os.path.getmtime(fn)))
+                    for fn in glob(join(infoDir, '*_info.json')))
+
+    def _getOutputMtimesFn(self):
+        return self._getExtraPath('output_info_mtimes.json')
+
+    def _loadOutputMtimes(self):
+        """ Return a dict {coordinatesSqlite: infoMtimes} with the info
+        files state when each output coordinates set was created.
+        """
+        mtimesFn = self._getOutputMtimesFn()
+        return loadJson(mtimesFn) if os.path.exists(mtimesFn) else {}
+
+    def _saveOutputMtimes(self, coordsFn, infoMtimes):
+        outputMtimes = dict(self._loadOutputMtimes())
+        outputMtimes[coordsFn] = infoMtimes
+        writeJson(outputMtimes, self._getOutputMtimesFn())
 
     def _useNewBoxer(self):
         return True if self.useNewBoxer else False
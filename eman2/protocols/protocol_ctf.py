@@ -24,9 +24,14 @@
 # *
 # **************************************************************************
 
+import os
+import re
+from glob import glob
+
 from pyworkflow.protocol.params import (FloatParam, EnumParam,
                                         BooleanParam)
-from pyworkflow.protocol.constants import LEVEL_ADVANCED
+from pyworkflow.object import Set
+from pyworkflow.protocol.constants import LEVEL_ADVANCED, STATUS_NEW
 import pyworkflow.utils as pwutils
 from pyworkflow.em import CTFModel
 from pyworkflow.em.data import SetOfParticles
@@ -34,7 +39,22 @@ from pyworkflow.em.protocol import ProtProcessParticles
 
 import eman2
 from eman2.constants import *
-from eman2.convert import writeSetOfParticles, iterLstFile, jsonToCtfModel
+from eman2.convert import (writeSetOfParticles, LstFile,
+                           updateCtfFromJson, loadJson, writeJson,
+                           getInfoJsonFn,
+                           getStructureFactorKey, linkStructureFactor,
+                           cacheStructureFactor)
+from eman2.objects import EmanSetOfParticlesLst
+
+
+# outputs that are always written, others are defined from their .lst
+FULL_OUTPUT_KEYS = ['FL']
+# streaming batches definition {batchId: [firstPartId, lastPartId]}
+BATCHES_FILE = 'batches.json'
+# info json modification times when the outputs were last written
+INFO_MTIMES_FILE = 'info_mtimes.json'
+# e2ctf_auto.py args that do not change the results (not used in cache keys)
+RUNTIME_ARGS = re.compile(r'\s*--(threads|verbose|ppid)[ =]\S+')
 
 
 class EmanProtCTFAuto(ProtProcessParticles):
@@ -122,10 +142,122 @@ class EmanProtCTFAuto(ProtProcessParticles):
     # --------------------------- INSERT steps functions ----------------------
     def _insertAllSteps(self):
         self._createFilenameTemplates()
-        self._insertFunctionStep('convertImagesStep')
         args = self._prepareParams()
-        self._insertFunctionStep('runCTFStep', args)
-        self._insertFunctionStep('createOutputStep')
+
+        self._streaming = self._isStreaming()
+
+        if self._streaming:
+            # particles are processed in batches as they arrive,
+            # the output sets are updated from _stepsCheck
+            self._batches = {}
+            self._ctfArgs = args
+            finalSteps = self._insertNewBatchesSteps(self._loadBatches())
+            self._insertFunctionStep('createStreamOutputStep',
+                                     prerequisites=finalSteps, wait=True)
+        else:
+            self._insertFunctionStep('convertImagesStep')
+            self._insertFunctionStep('runCTFStep', args)
+            self._insertFunctionStep('createOutputStep')
+
+    def _insertNewBatchesSteps(self, batches):
+        """ Insert the convert and CTF steps for each new batch.
+        Params:
+            batches: dict {batchId: (firstPartId, lastPartId)}
+        """
+        deps = []
+        firstCtfStep = getattr(self, '_firstCtfStep', None)
+
+        for batchId in sorted(batches):
+            firstId, lastId = batches[batchId]
+            convId = self._insertFunctionStep('convertBatchStep', batchId,
+                                              firstId, lastId,
+                                              prerequisites=[])
+            prereqs = [convId]
+            # all batches reuse the structure factor of the first one
+            if firstCtfStep is not None:
+                prereqs.append(firstCtfStep)
+            ctfId = self._insertFunctionStep('runCTFBatchStep', batchId,
+                                             self._ctfArgs,
+                                             prerequisites=prereqs)
+            if firstCtfStep is None:
+                firstCtfStep = self._firstCtfStep = ctfId
+            self._batches[batchId] = (firstId, lastId)
+            deps.append(ctfId)
+
+        return deps
+
+    def _stepsCheck(self):
+        if getattr(self, '_streaming', False):
+            self._checkNewInput()
+            self._checkNewOutput()
+
+    def _checkNewInput(self):
+        """ Check for new particles and insert a new batch with them. """
+        partSet = self._loadInputParticles()
+        lastId = max([b[1] for b in self._batches.values()] or [0])
+        newIds = [p.getObjId() for p in partSet.iterItems(where='id > %d' % lastId)]
+        self._streamClosed = partSet.isStreamClosed()
+        partSet.close()
+
+        if newIds:
+            batchId = max(self._batches.keys() or [0]) + 1
+            newBatch = {batchId: (min(newIds), max(newIds))}
+            self._saveBatches(newBatch)
+            deps = self._insertNewBatchesSteps(newBatch)
+            outputStep = self._getFirstJoinStep()
+            if outputStep is not None:
+                outputStep.addPrerequisites(*deps)
+            self.updateSteps()
+
+    def _checkNewOutput(self):
+        """ Append the particles of the finished batches to the outputs. """
+        outputBatches = [b for b in self._batches
+                         if os.path.exists(self._getBatchPath(b, 'OUTPUT'))]
+        doneBatches = [b for b in sorted(self._batches)
+                       if b not in outputBatches and
+                       os.path.exists(self._getBatchPath(b, 'DONE'))]
+        allDone = (len(outputBatches) + len(doneBatches) ==
+                   len(self._batches))
+        finished = getattr(self, '_streamClosed', False) and allDone
+
+        if not doneBatches and not finished:
+            return
+
+        inputSet = self._loadInputParticles()
+        outputSets = self._getOutputSets()
+        keys = sorted(outputSets.keys())
+        sets = dict((key, self._loadOutputSet(key, inputSet)) for key in keys)
+
+        for batchId in doneBatches:
+            firstId, lastId = self._batches[batchId]
+            lstIters = dict(
+                (key, iter(LstFile(self._getBatchLstFile(batchId, fn))))
+                for key, fn in outputSets.iteritems())
+            partIter = inputSet.iterItems(where='id >= %d AND id <= %d'
+                                                % (firstId, lastId))
+            self._appendParticles(partIter, sets, lstIters,
+                                  self._getBatchPath(batchId))
+            open(self._getBatchPath(batchId, 'OUTPUT'), 'w').close()
+        inputSet.close()
+
+        streamMode = Set.STREAM_CLOSED if finished else Set.STREAM_OPEN
+        for key in keys:
+            outputSet = sets[key]
+            outputName = self._getOutputName(key)
+            firstTime = not self.hasAttribute(outputName)
+            if outputSet.getSize() and not outputSet.getSamplingRate():
+                newPix = self._getNewPixSize(outputSet.getDim()[0])
+                outputSet.setSamplingRate(newPix)
+            self._updateOutputSet(outputName, outputSet, streamMode)
+            if firstTime:
+                self._defineSourceRelation(self.inputParticles,
+                                           getattr(self, outputName))
+
+        if finished:  # unlock createStreamOutputStep
+            self._saveInfoMtimes()
+            outputStep = self._getFirstJoinStep()
+            if outputStep is not None and outputStep.isWaiting():
+                outputStep.setStatus(STATUS_NEW)
 
     # --------------------------- STEPS functions -----------------------------
     def convertImagesStep(self):
@@ -135,42 +267,143 @@ class EmanProtCTFAuto(ProtProcessParticles):
         pwutils.makePath(storePath)
         writeSetOfParticles(partSet, storePath, alignType=partAlign)
 
-    def runCTFStep(self, args):
+    def runCTFStep(self, args, cwd=None):
         """ Run the EMAN e2ctf_auto.py program. """
+        # streaming batches share the structure factor of the first one,
+        # otherwise it is reused from previous runs with the same input
+        sfKey = None
+        if cwd is None:
+            partSet = self._getInputParticles()
+            sfKey = getStructureFactorKey(partSet,
+                                          RUNTIME_ARGS.sub('', args).strip())
+            if linkStructureFactor(partSet, self._getExtraPath(), sfKey):
+                sfKey = None  # not computed here, not cached again
+
         program = eman2.Plugin.getProgram('e2ctf_auto.py')
-        self.runJob(program, args, cwd=self._getExtraPath(),
+        self.runJob(program, args, cwd=cwd or self._getExtraPath(),
                     numberOfThreads=1)
 
+        if sfKey is not None:
+            cacheStructureFactor(self._getExtraPath(), sfKey)
+
+    def convertBatchStep(self, batchId, firstId, lastId):
+        """ Convert the particles of a streaming batch and prepare the
+        EMAN project folder where e2ctf_auto.py will process them.
+        """
+        inputSet = self._loadInputParticles()
+        batchSet = SetOfParticles(filename=self._getTmpPath('batch_%03d.sqlite'
+                                                            % batchId))
+        batchSet.copyInfo(inputSet)
+        for part in inputSet.iterItems(where='id >= %d AND id <= %d'
+                                             % (firstId, lastId)):
+            batchSet.append(part)
+        batchSet.write()
+        inputSet.close()
+
+        storePath = self._getBatchPath(batchId, 'particles')
+        pwutils.makePath(storePath, self._getExtraPath('info'))
+        writeSetOfParticles(batchSet, storePath,
+                            alignType=batchSet.getAlignment(),
+                            suffix='_b%03d' % batchId)
+        batchSet.close()
+        # micrograph CTF fits of all batches are kept together
+        pwutils.createLink(self._getExtraPath('info'),
+                           self._getBatchPath(batchId, 'info'))
+
+    def runCTFBatchStep(self, batchId, args):
+        """ Run e2ctf_auto.py on a streaming batch. The first batch computes
+        the structure factor, the following ones reuse it.
+        """
+        sfFn = self._getExtraPath(STRUCFAC)
+        if os.path.exists(sfFn):
+            # a copy, so e2ctf_auto.py never writes through to the shared one
+            pwutils.copyFile(sfFn, self._getBatchPath(batchId, STRUCFAC))
+
+        self.runCTFStep(args, cwd=self._getBatchPath(batchId))
+
+        batchSfFn = self._getBatchPath(batchId, STRUCFAC)
+        if not os.path.exists(sfFn) and os.path.exists(batchSfFn):
+            pwutils.copyFile(batchSfFn, sfFn)
+        open(self._getBatchPath(batchId, 'DONE'), 'w').close()
+
+    def createStreamOutputStep(self):
+        # Output sets are updated and closed from _checkNewOutput
+        pass
+
     def createOutputStep(self):
         inputSet = self._getInputParticles()
         outputSets = self._getOutputSets()
         outputs = {}
-
-        for key, fn in outputSets.iteritems():
-            outputSet = self._createSetOfParticles(suffix='_%s' % key)
+        # parsed CTF per micrograph info json, shared by all output sets
+        self._ctfCache = {}
+        # Only the full resolution particles are written to sqlite, the
+        # other variants only differ in file location and sampling rate,
+        # so they are defined from the input set and their .lst files
+        # and written the first time they are used
+        keys = sorted(outputSets.keys())
+        fullKeys = [key for key in keys if key in FULL_OUTPUT_KEYS]
+        sets = {}
+        lstIters = {}
+
+        for key in keys:
+            if key in fullKeys:
+                outputSet = self._createSetOfParticles(suffix='_%s' % key)
+                lstIters[key] = iter(LstFile(self._getFileName(outputSets[key])))
+            else:
+                outputSet = self._createSetOfParticlesLst(suffix='_%s' % key)
             outputSet.copyInfo(inputSet)
             outputSet.setIsPhaseFlipped(True)
             outputSet.setHasCTF(True)
-            outputSet.copyItems(inputSet,
-                                updateItemCallback=self._updateCTF,
-                                itemDataIterator=iterLstFile(self._getFileName(fn)))
-            newPix = self._getNewPixSize(outputSet.getDimensions()[0])
+            sets[key] = outputSet
+
+        size = self._appendParticles(inputSet.iterItems(), sets, lstIters,
+                                     self._getExtraPath())
+
+        for key in keys:
+            outputSet = sets[key]
+            if key not in fullKeys:
+                outputSet.setBaseSet(self.inputParticles,
+                                     self._getFileName(outputSets[key]),
+                                     size=size)
+            newPix = self._getNewPixSize(outputSet.getDim()[0])
             outputSet.setSamplingRate(newPix)
 
             summary = self.getSummary(key)
             outputSet.setObjComment(summary)
-            if key == 'FL':
-                outputName = 'outputParticles_flip_fullRes'
-            elif key == 'bispec':
-                outputName = 'outputParticles_flip_bispec'
-            else:
-                outputName = 'outputParticles_flip_lp%s' % key
-
-            outputs[outputName] = outputSet
+            outputs[self._getOutputName(key)] = outputSet
 
         self._defineOutputs(**outputs)
         for _, out in self.iterOutputAttributes(SetOfParticles):
             self._defineSourceRelation(inputSet, out)
+        self._saveInfoMtimes()
+
+    def updateOutputCtf(self):
+        """ Update in place the CTF of the output particles whose micrograph
+        info json changed since the outputs were written (e.g. after
+        editing the fit with the e2ctf.py GUI).
+        Return the number of updated particles.
+        """
+        changedFiles = self._getChangedInfoFiles()
+        count = 0
+        self._ctfCache = {}
+
+        for _, outputSet in self.iterOutputAttributes(SetOfParticles):
+            if (isinstance(outputSet, EmanSetOfParticlesLst) and
+                    not outputSet.isMaterialized()):
+                continue  # the current CTF will be read when materialized
+            # rows are updated after the iteration, only the changed ones
+            changedParts = [part.clone() for part in outputSet.iterItems()
+                            if os.path.basename(getInfoJsonFn(part.getFileName()))
+                            in changedFiles]
+            for part in changedParts:
+                self._updateCTF(part, part.getFileName())
+                outputSet.update(part)
+            outputSet.write()
+            outputSet.close()
+            count += len(changedParts)
+
+        self._saveInfoMtimes()
+        return count
 
     # --------------------------- INFO functions ------------------------------
     def _validate(self):
@@ -243,12 +476,12 @@ class EmanProtCTFAuto(ProtProcessParticles):
     def _getInputParticles(self):
         return self.inputParticles.get()
 
-    def _updateCTF(self, item, row):
-        fileName = self._getExtraPath(row[1])
-        item.setLocation(row[0], fileName)
+    def _updateCTF(self, item, fileName):
         if not item.hasCTF():
             item.setCTF(CTFModel())
-        jsonToCtfModel(fileName, item.getCTF())
+        if getattr(self, '_ctfCache', None) is None:
+            self._ctfCache = {}
+        updateCtfFromJson(item.getCTF(), fileName, self._ctfCache)
 
     def _getOutputSets(self):
         protType = self.getEnumText('type')
@@ -270,6 +503,134 @@ class EmanProtCTFAuto(ProtProcessParticles):
 
         return outputs
 
+    def _appendParticles(self, partIter, sets, lstIters, lstDir):
+        """ Fill the output sets in a single pass over the input
+        particles, reading their .lst files in lockstep.
+        Params:
+            partIter: iterator over the input particles.
+            sets: dict {key: outputSet}, only the sets with an
+                iterator in lstIters will be filled.
+            lstIters: dict {key: iter(LstFile(lstFile))}.
+            lstDir: folder to which the .lst paths are relative.
+        Return the number of enabled particles.
+        """
+        keys = sorted(lstIters.keys())
+        size = 0
+        fileNames = {}  # full paths, computed once per stack
+
+        for part in partIter:
+            rows = [(key, next(lstIters[key])) for key in keys]
+            if not part.isEnabled():
+                continue  # just skip disabled data rows
+            size += 1
+            for i, (key, row) in enumerate(rows):
+                if row[1] not in fileNames:
+                    fileNames[row[1]] = os.path.join(lstDir, row[1])
+                fileName = fileNames[row[1]]
+                part.setLocation(row[0], fileName)
+                if i == 0:  # all variants share the same micrograph CTF
+                    self._updateCTF(part, fileName)
+                sets[key].append(part)
+
+        return size
+
+    def _isStreaming(self):
+        return self._getInputParticles().isStreamOpen()
+
+    def _loadInputParticles(self):
+        """ Load a fresh copy of the input particles, it may have been
+        updated since the protocol started.
+        """
+        partSet = SetOfParticles(filename=self._getInputParticles().getFileName())
+        partSet.loadAllProperties()
+        return partSet
+
+    def _loadOutputSet(self, key, inputSet):
+        """ Load (or create) a streaming output set.
+        Unlike createOutputStep, all variants are written as regular sets:
+        an EmanSetOfParticlesLst needs a single .lst file matching a
+        closed base set, while here the input grows and each batch has its
+        own .lst files. Besides, consumers of an open stream read the set
+        on every update, so it would be materialized at the first batch.
+        """
+        setFn = self._getPath('particles_%s.sqlite' % key)
+        outputSet = SetOfParticles(filename=setFn)
+        if os.path.exists(setFn):
+            outputSet.loadAllProperties()
+            outputSet.enableAppend()
+        else:
+            outputSet.setStreamState(outputSet.STREAM_OPEN)
+            outputSet.copyInfo(inputSet)
+            outputSet.setIsPhaseFlipped(True)
+            outputSet.setHasCTF(True)
+            outputSet.setSamplingRate(None)
+            outputSet.setObjComment(self.getSummary(key))
+        return outputSet
+
+    def _loadBatches(self):
+        """ Batches are stored on disk, so the same steps are inserted
+        when the protocol is resumed.
+        """
+        batchesFn = self._getExtraPath(BATCHES_FILE)
+        if os.path.exists(batchesFn):
+            batches = loadJson(batchesFn)
+            return dict((int(k), tuple(v)) for k, v in batches.iteritems())
+        return {}
+
+    def _saveBatches(self, newBatches):
+        batches = self._loadBatches()
+        batches.update(newBatches)
+        writeJson(batches, self._getExtraPath(BATCHES_FILE))
+
+    def _getBatchPath(self, batchId, *paths):
+        return self._getExtraPath('batch_%03d' % batchId, *paths)
+
+    def _getBatchLstFile(self, batchId, fnKey):
+        lstName = os.path.basename(self._getFileName(fnKey))
+        return self._getBatchPath(batchId, 'sets', lstName)
+
+    def _getFirstJoinStep(self):
+        for step in self._steps:
+            if step.funcName.get() == 'createStreamOutputStep':
+                return step
+        return None
+
+    def _createSetOfParticlesLst(self, suffix=''):
+        """ Create a set of particles that will be filled from an .lst file
+        only when its items are requested.
+        """
+        setFn = self._getPath('particles%s.sqlite' % suffix)
+        pwutils.cleanPath(setFn)
+        return EmanSetOfParticlesLst(filename=setFn)
+
+    def _getOutputName(self, key):
+        if key == 'FL':
+            return 'outputParticles_flip_fullRes'
+        elif key == 'bispec':
+            return 'outputParticles_flip_bispec'
+        else:
+            return 'outputParticles_flip_lp%s' % key
+
+    def _getInfoMtimes(self):
+        """ Return a dict {infoJsonFn: mtime} for all micrographs. """
+        infoFiles = glob(self._getExtraPath('info', '*_info.json'))
+        # the mtime is stored as a string to compare it exactly once saved
+        return dict((fn, repr(os.path.getmtime(fn))) for fn in infoFiles)
+
+    def _saveInfoMtimes(self):
+        """ Store the info json modification times used in the outputs. """
+        writeJson(self._getInfoMtimes(), self._getExtraPath(INFO_MTIMES_FILE))
+
+    def _getChangedInfoFiles(self):
+        """ Return the names of the info json files modified since
+        the last output (streaming batches link the same info folder).
+        """
+        mtimesFn = self._getExtraPath(INFO_MTIMES_FILE)
+        oldMtimes = loadJson(mtimesFn) if os.path.exists(mtimesFn) else {}
+        return set(os.path.basename(fn)
+                   for fn, mtime in self._getInfoMtimes().iteritems()
+                   if oldMtimes.get(fn) != mtime)
+
     def _getNewPixSize(self, newBox):
         # calculates new pix size for binned particles
         inputParts = self.inputParticles.get()
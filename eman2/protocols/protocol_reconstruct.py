@@ -25,6 +25,7 @@
 # **************************************************************************
 
 import os
+from glob import glob
 
 from pyworkflow.protocol.params import (PointerParam, FloatParam, IntParam,
                                         EnumParam, StringParam, BooleanParam,
@@ -34,7 +35,9 @@ from pyworkflow.em.data import Volume
 from pyworkflow.em.protocol import ProtReconstruct3D
 
 import eman2
-from eman2.convert import writeSetOfParticles
+from eman2.convert import (writeSetOfParticles, linkStructureFactor,
+                           updateStacksCtf, getStructureFactorKey,
+                           cacheStructureFactor)
 from eman2.constants import *
 
 
@@ -193,7 +196,16 @@ class EmanProtReconstruct(ProtReconstruct3D):
         partAlign = partSet.getAlignment()
         storePath = self._getExtraPath("particles")
         makePath(storePath)
-        writeSetOfParticles(partSet, storePath, alignType=partAlign)
+        # when e2ctf.py runs, the known CTF is stored for each micrograph
+        # so only the SNR (and structure factor if missing) is computed
+        infoPath = None if self.skipctf else self._getExtraPath('info')
+        # the __ctf_flip stacks are written while converting the particles
+        flipSet = not (self.skipctf or partSet.isPhaseFlipped())
+        phaseFlip = flipSet and partSet.hasCTF()
+        # the sets/inputSet*.lst files are written in the conversion order
+        writeSetOfParticles(partSet, storePath, alignType=partAlign,
+                            infoPath=infoPath, phaseFlip=phaseFlip,
+                            setName='inputSet', flipSet=flipSet)
         if not self.skipctf:
             program = eman2.Plugin.getProgram('e2ctf.py')
             acq = partSet.getAcquisition()
@@ -201,17 +213,26 @@ class EmanProtReconstruct(ProtReconstruct3D):
             args = " --voltage %3d" % acq.getVoltage()
             args += " --cs %f" % acq.getSphericalAberration()
             args += " --ac %f" % (100 * acq.getAmplitudeContrast())
-            if not partSet.isPhaseFlipped():
+            if not (phaseFlip or partSet.isPhaseFlipped()):
                 args += " --phaseflip"
-            args += " --computesf --apix %f " % partSet.getSamplingRate()
+            sfKey = getStructureFactorKey(partSet)
+            hasSf = linkStructureFactor(partSet, self._getExtraPath(), sfKey)
+            if not hasSf:
+                args += " --computesf"
+            args += " --apix %f " % partSet.getSamplingRate()
             args += " --allparticles --autofit --curdefocusfix --storeparm -v 8"
             args += " --threads=%d" % self.numberOfThreads.get()
             self.runJob(program, args, cwd=self._getExtraPath(),
                         numberOfThreads=1)
-
-        program = eman2.Plugin.getProgram('e2buildsets.py')
-        args = " --setname=inputSet --allparticles --minhisnr=-1"
-        self.runJob(program, args, cwd=self._getExtraPath(), numberOfThreads=1)
+            if not hasSf:
+                cacheStructureFactor(self._getExtraPath(), sfKey)
+            if phaseFlip:
+                # store the SNR computed by e2ctf.py in the flipped particles
+                flipFiles = glob(self._getExtraPath('particles',
+                                                    '*__ctf_flip.hdf'))
+                updateStacksCtf([os.path.relpath(fn, self._getExtraPath())
+                                 for fn in flipFiles],
+                                cwd=self._getExtraPath())
 
     def reconstructVolumeStep(self, args):
         """ Run the EMAN program to reconstruct a volume. """
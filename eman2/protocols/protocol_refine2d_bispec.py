@@ -38,7 +38,9 @@ from pyworkflow.utils import makePath, createLink, cleanPath
 
 
 import eman2
-from eman2.convert import writeSetOfParticles
+from eman2.convert import (writeSetOfParticles, linkStructureFactor,
+                           updateStacksCtf, getStructureFactorKey,
+                           cacheStructureFactor)
 from eman2.constants import *
 
 
@@ -267,12 +269,22 @@ class EmanProtRefine2DBispec(em.ProtClassify2D):
         partAlign = partSet.getAlignment()
         storePath = self._getExtraPath("particles")
         makePath(storePath)
-        writeSetOfParticles(partSet, storePath, alignType=partAlign)
 
         if self.useInputBispec and self.inputBispec is not None:
             print("Skipping CTF estimation since input bispectra were provided")
             self.skipctf.set(True)
 
+        # when e2ctf.py runs, the known CTF is stored for each micrograph
+        # so only the SNR (and structure factor if missing) is computed
+        infoPath = None if self.skipctf else self._getExtraPath('info')
+        # the __ctf_flip stacks are written while converting the particles
+        flipSet = not (self.skipctf or partSet.isPhaseFlipped())
+        phaseFlip = flipSet and partSet.hasCTF()
+        # the sets/inputSet*.lst files are written in the conversion order
+        writeSetOfParticles(partSet, storePath, alignType=partAlign,
+                            infoPath=infoPath, phaseFlip=phaseFlip,
+                            setName='inputSet', flipSet=flipSet)
+
         if not self.skipctf:
             program = eman2.Plugin.getProgram('e2ctf.py')
             acq = partSet.getAcquisition()
@@ -281,17 +293,25 @@ class EmanProtRefine2DBispec(em.ProtClassify2D):
             args += " --cs %f" % acq.getSphericalAberration()
             args += " --ac %f" % (100 * acq.getAmplitudeContrast())
             args += " --threads=%d" % self.numberOfThreads.get()
-            if not partSet.isPhaseFlipped():
+            if not (phaseFlip or partSet.isPhaseFlipped()):
                 args += " --phaseflip"
-            args += " --computesf --apix %f" % partSet.getSamplingRate()
+            sfKey = getStructureFactorKey(partSet)
+            hasSf = linkStructureFactor(partSet, self._getExtraPath(), sfKey)
+            if not hasSf:
+                args += " --computesf"
+            args += " --apix %f" % partSet.getSamplingRate()
             args += " --allparticles --autofit --curdefocusfix --storeparm -v 8"
             self.runJob(program, args, cwd=self._getExtraPath(),
                         numberOfMpi=1, numberOfThreads=1)
-
-        program = eman2.Plugin.getProgram('e2buildsets.py')
-        args = " --setname=inputSet --allparticles --minhisnr=-1"
-        self.runJob(program, args, cwd=self._getExtraPath(),
-                    numberOfMpi=1, numberOfThreads=1)
+            if not hasSf:
+                cacheStructureFactor(self._getExtraPath(), sfKey)
+            if phaseFlip:
+                # store the SNR computed by e2ctf.py in the flipped particles
+                flipFiles = glob(self._getExtraPath('particles',
+                                                    '*__ctf_flip.hdf'))
+                updateStacksCtf([os.path.relpath(fn, self._getExtraPath())
+                                 for fn in flipFiles],
+                                cwd=self._getExtraPath())
 
         if self.useInputBispec:
             prot = self.inputBispec.get()
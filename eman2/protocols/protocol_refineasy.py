@@ -36,7 +36,10 @@ from pyworkflow.utils.path import cleanPattern, makePath, createLink, exists
 from pyworkflow.em.data import Volume
 
 import eman2
-from eman2.convert import rowToAlignment, writeSetOfParticles
+from eman2.convert import (rowToAlignment, writeSetOfParticles,
+                           linkStructureFactor, updateStacksCtf,
+                           getStructureFactorKey, cacheStructureFactor,
+                           registerConvertedStacks)
 from eman2.constants import *
 
 
@@ -130,6 +133,16 @@ Major features of this program:
                       help='Use this if you want to skip running e2ctf.py. '
                            'It is not recommended to skip this step unless CTF '
                            'estimation was already done with EMAN2.')
+        form.addParam('copyParticles', BooleanParam, default=True,
+                      expertLevel=LEVEL_ADVANCED, condition='skipctf',
+                      label='Copy particles to EMAN stacks?',
+                      help='If set to No, no image is written: EMAN reads the '
+                           'particles from the input stacks through the '
+                           'sets/inputSet.lst file. EMAN takes the sampling '
+                           'rate from the image headers, so this is only done '
+                           'for .mrcs stacks with the right sampling rate, '
+                           'and particles without CTF or alignment. Otherwise '
+                           'the particles are copied.')
         form.addParam('numberOfIterations', IntParam, default=6,
                       label='Number of iterations',
                       help='The total number of refinement iterations to '
@@ -275,8 +288,22 @@ Major features of this program:
         partAlign = partSet.getAlignment()
         storePath = self._getExtraPath("particles")
         makePath(storePath)
-        writeSetOfParticles(partSet, storePath, alignType=partAlign)
-        if not self.skipctf:
+        # when e2ctf.py runs, the known CTF is stored for each micrograph
+        # so only the SNR (and structure factor if missing) is computed
+        infoPath = None if self.skipctf else self._getExtraPath('info')
+        # the __ctf_flip stacks are written while converting the particles
+        flipSet = not (self.skipctf or partSet.isPhaseFlipped())
+        phaseFlip = flipSet and partSet.hasCTF()
+        # the sets/inputSet*.lst files are written in the conversion order
+        # the stacks (and CTF) of a previous conversion of the same
+        # particles, e.g. a subset of classes, are reused if possible
+        converted = {}
+        reused = writeSetOfParticles(
+            partSet, storePath, alignType=partAlign, infoPath=infoPath,
+            phaseFlip=phaseFlip, setName='inputSet', flipSet=flipSet,
+            lstOnly=self.skipctf and not self.copyParticles, reuseStacks=True,
+            converted=converted)
+        if not (self.skipctf or reused):
             program = eman2.Plugin.getProgram('e2ctf.py')
             acq = partSet.getAcquisition()
 
@@ -284,17 +311,28 @@ Major features of this program:
             args += " --cs %f" % acq.getSphericalAberration()
             args += " --ac %f" % (100 * acq.getAmplitudeContrast())
             args += " --threads=%d" % self.numberOfThreads.get()
-            if not partSet.isPhaseFlipped():
+            if not (phaseFlip or partSet.isPhaseFlipped()):
                 args += " --phaseflip"
-            args += " --computesf --apix %f" % partSet.getSamplingRate()
+            sfKey = getStructureFactorKey(partSet)
+            hasSf = linkStructureFactor(partSet, self._getExtraPath(), sfKey)
+            if not hasSf:
+                args += " --computesf"
+            args += " --apix %f" % partSet.getSamplingRate()
             args += " --allparticles --autofit --curdefocusfix --storeparm -v 8"
             self.runJob(program, args, cwd=self._getExtraPath(),
                         numberOfMpi=1, numberOfThreads=1)
-
-        program = eman2.Plugin.getProgram('e2buildsets.py')
-        args = " --setname=inputSet --allparticles --minhisnr=-1"
-        self.runJob(program, args, cwd=self._getExtraPath(),
-                    numberOfMpi=1, numberOfThreads=1)
+            if not hasSf:
+                cacheStructureFactor(self._getExtraPath(), sfKey)
+            if phaseFlip:
+                # store the SNR computed by e2ctf.py in the flipped particles
+                flipFiles = glob(self._getExtraPath('particles',
+                                                    '*__ctf_flip.hdf'))
+                updateStacksCtf([os.path.relpath(fn, self._getExtraPath())
+                                 for fn in flipFiles],
+                                cwd=self._getExtraPath())
+            # only stacks processed by e2ctf.py (with their SNR and
+            # structure factor) are offered to other runs
+            registerConvertedStacks(converted)
 
     def refineStep(self, args):
         """ Run the EMAN program to refine a volume. """
@@ -198,15 +198,10 @@ class EmanProtTiltValidate(ProtAnalysis3D):
         for partSet, suffix in zip([partUnt, partTilt],
                                    ['_untilted_ptcls', '_tilted_ptcls']):
             partAlign = partSet.getAlignment()
+            # also writes sets/untilted_ptcls.lst and sets/tilted_ptcls.lst
             writeSetOfParticles(partSet, storePath,
-                                alignType=partAlign, suffix=suffix)
-
-            setName = suffix.split('_')[1]
-            program = eman2.Plugin.getProgram('e2buildsets.py')
-            args = " particles/*%s.hdf --setname=%s --minhisnr=-1" % (
-                suffix, setName)
-            self.runJob(program, args, cwd=self._getExtraPath(),
-                        numberOfMpi=1, numberOfThreads=1)
+                                alignType=partAlign, suffix=suffix,
+                                setName=suffix[1:])
 
     def runValidateStep(self, args):
         program = eman2.Plugin.getProgram('e2tiltvalidate.py')
@@ -25,6 +25,8 @@
 # **************************************************************************
 
 
+import os
+
 from pyworkflow.tests import *
 import pyworkflow.em as pwem
 from pyworkflow.utils import importFromPlugin
@@ -317,6 +319,724 @@ class TestEmanCtfAuto(TestEmanBase):
                              "There was a problem with eman ctf auto protocol")
 
 
+class TestEmanLstFile(BaseTest):
+    @classmethod
+    def setUpClass(cls):
+        setupTestOutput(cls)
+
+    def test_readWrite(self):
+        from eman2.convert import writeLstFile, LstFile
+        lstFn = self.getOutputPath('test.lst')
+        entries = [(0, 'particles/mic_1.hdf'), (1, 'particles/mic_1.hdf'),
+                   (10, 'particles/mic_10__ctf_flip.hdf'),
+                   (2, 'particles/mic_1.hdf', '{"apix":1.5}')]
+        writeLstFile(lstFn, entries)
+
+        lst = LstFile(lstFn)
+        self.assertEqual(len(lst), len(entries))
+        self.assertEqual(lst.read(2), (11, 'particles/mic_10__ctf_flip.hdf'))
+        self.assertEqual(list(lst), [(e[0] + 1, e[1]) for e in entries])
+
+        indexes, fileIds, fileNames = lst.readAll()
+        self.assertEqual(indexes.tolist(), [1, 2, 11, 3])
+        self.assertEqual(len(fileNames), 2)
+        self.assertEqual([fileNames[i] for i in fileIds],
+                         [e[1] for e in entries])
+
+        # the same result when parsed in several chunks
+        lst.CHUNK_LINES = 3
+        self.assertEqual(list(lst), [(e[0] + 1, e[1]) for e in entries])
+
+
+class TestEmanGaussPicker(BaseTest):
+    """ NumPy gaussian picker, run on a synthetic micrograph. """
+    def test_pick(self):
+        import numpy
+        from eman2.convert.gausspicker import GaussianPicker
+        positions = numpy.array([[96, 104], [304, 120], [200, 296],
+                                 [408, 400], [120, 392]])
+        y, x = numpy.mgrid[0:512, 0:480]
+        image = numpy.random.RandomState(0).normal(0, 0.01, x.shape)
+        image += 5e-4 * x  # a ramp, removed by the picker
+        for px, py in positions:
+            # dark particles
+            image -= numpy.exp(-((x - px) ** 2 + (y - py) ** 2) / 72.)
+
+        picker = GaussianPicker(64, gaussWidth=1.0, lowerThreshold=0.,
+                                higherThreshold=1e6, doInvert=True)
+        boxes = picker.pick([image.astype(numpy.float32)])[0]
+        self.assertEqual(len(boxes), len(positions))
+        for px, py in positions:
+            dists = numpy.hypot(boxes[:, 0] - px, boxes[:, 1] - py)
+            self.assertLessEqual(dists.min(), picker.shrink)
+
+
+class TestEmanConverterStandin(BaseTest):
+    """ Run e2converter.py with the EMAN2 stand-in (no EMAN needed). """
+    @classmethod
+    def setUpClass(cls):
+        setupTestOutput(cls)
+
+    def test_writeParticles(self):
+        import json
+        import numpy
+        try:
+            from eman2 import e2standin
+        except ImportError:
+            self.skipTest('h5py is required by the EMAN2 stand-in')
+
+        stackFn = self.getOutputPath('input.mrcs')
+        for i in range(3):
+            image = e2standin.EMNumPy.numpy2em(numpy.random.rand(32, 32))
+            image.set_attr('apix_x', 2.0)
+            image.write_image(stackFn, i)
+
+        hdfFn = self.getOutputPath('output.hdf')
+        flipFn = self.getOutputPath('output__ctf_flip.hdf')
+        lines = [json.dumps({'_index': i, '_filename': stackFn,
+                             '_samplingRate': 2.0,
+                             '_ctfModel._defocusU': 20000.,
+                             '_ctfModel._defocusV': 18000.,
+                             '_ctfModel._defocusAngle': 30.,
+                             '_acquisition._voltage': 300.,
+                             '_acquisition._sphericalAberration': 2.7,
+                             '_acquisition._amplitudeContrast': 0.1,
+                             'hdfFn': hdfFn, 'flipFn': flipFn})
+                 for i in range(3)]
+
+        self._runConverter(lines)
+        for fn in [hdfFn, flipFn]:
+            self.assertEqual(e2standin.EMUtil.get_image_count(fn), 3)
+            image = e2standin.EMData(fn, 2)
+            self.assertEqual(image.get_xsize(), 32)
+            self.assertAlmostEqual(image.get_attr('ctf').defocus, 1.9)
+
+    def test_phaseFlip(self):
+        import json
+        import math
+        import numpy
+        try:
+            from eman2 import e2standin
+        except ImportError:
+            self.skipTest('h5py is required by the EMAN2 stand-in')
+
+        data = numpy.random.RandomState(0).rand(32, 32) + 10
+        stackFn = self.getOutputPath('flip_input.hdf')
+        image = e2standin.EMNumPy.numpy2em(data)
+        image.set_attr('ptcl_source_coord', [100, 200])
+        image.write_image(stackFn, 0)
+
+        flipFn = self.getOutputPath('flip__ctf_flip.hdf')
+        self._runConverter([json.dumps({
+            '_index': 0, '_filename': stackFn, '_samplingRate': 2.0,
+            '_ctfModel._defocusU': 20000., '_ctfModel._defocusV': 18000.,
+            '_ctfModel._defocusAngle': 30., '_acquisition._voltage': 300.,
+            '_acquisition._sphericalAberration': 2.7,
+            '_acquisition._amplitudeContrast': 0.1, 'flipFn': flipFn})])
+        flipped = e2standin.EMData(flipFn, 0)
+        self.assertEqual(flipped.get_attr('ptcl_source_coord'), [100, 200])
+        self.assertEqual(flipped.get_attr('apix_y'), 2.0)
+
+        # edge mean normalization, then the CTF sign flip (in Angstroms)
+        edge = numpy.concatenate([data[0], data[-1], data[1:-1, 0],
+                                  data[1:-1, -1]])
+        expected = (data - edge.mean()) / data.std()
+        ky = numpy.fft.fftfreq(32)[:, None] / 2.0
+        kx = numpy.fft.rfftfreq(32)[None, :] / 2.0
+        s2 = kx ** 2 + ky ** 2
+        defocus = 19000. + 1000. * numpy.cos(
+            2 * (numpy.arctan2(ky, kx) - math.radians(30.)))
+        wavelength = 12.2639 / math.sqrt(300e3 + 0.97845e-6 * 300e3 ** 2)
+        gamma = (math.pi * wavelength * defocus * s2 -
+                 math.pi / 2 * 2.7e7 * wavelength ** 3 * s2 ** 2)
+        ctf = math.sqrt(1 - 0.01) * numpy.sin(gamma) + 0.1 * numpy.cos(gamma)
+        expected = numpy.fft.irfft2(numpy.fft.rfft2(expected) *
+                                    numpy.where(ctf < 0, -1, 1), s=(32, 32))
+        self.assertTrue(numpy.allclose(flipped.numpy(), expected, atol=1e-4))
+
+    def _runConverter(self, lines):
+        """ Run e2converter.py write with the stand-in. """
+        import subprocess
+        import sys
+        from eman2 import e2standin
+        env = dict(os.environ, EMAN2STANDIN='1')
+        script = os.path.join(os.path.dirname(e2standin.__file__),
+                              'e2converter.py')
+        proc = subprocess.Popen([sys.executable, script, 'write'], env=env,
+                                stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+        out, _ = proc.communicate('\n'.join(lines) + '\n')
+        self.assertEqual(proc.returncode, 0)
+        self.assertEqual(out.split(), ['OK'] * len(lines))
+
+
+class TestEmanConvertBase(BaseTest):
+    """ Base for the conversion unit tests, run from the output folder. """
+    @classmethod
+    def setUpClass(cls):
+        setupTestOutput(cls)
+
+    def setUp(self):
+        # the project cache is relative to the current folder
+        self._cwd = os.getcwd()
+        os.chdir(self.getOutputPath())
+
+    def tearDown(self):
+        os.chdir(self._cwd)
+
+    def _createParticles(self, setFn, sourceFn, size, samplingRate=None):
+        partSet = pwem.SetOfParticles(filename=setFn)
+        partSet.setSamplingRate(samplingRate)
+        for i in range(1, size + 1):
+            part = pwem.Particle()
+            part.setLocation(i, sourceFn)
+            part.setSamplingRate(samplingRate)
+            partSet.append(part)
+        partSet.write()
+        return partSet
+
+    def _writeFile(self, fn, data='data'):
+        from pyworkflow.utils import makePath
+        makePath(os.path.dirname(fn))
+        with open(fn, 'a') as f:
+            f.write(data)
+
+    def _writeMrc(self, fn, n, apix, size=16):
+        """ Write an MRC file with n images of zeros. """
+        import numpy
+        header = numpy.zeros(256, dtype='<i4')
+        header[:4] = [size, size, n, 2]
+        header[7:10] = [size, size, n]
+        header[10:13] = numpy.array([size * apix, size * apix, n * apix],
+                                    dtype='<f4').view('<i4')
+        with open(fn, 'wb') as f:
+            f.write(header.tostring())
+            f.write(numpy.zeros((n, size, size), dtype='<f4').tostring())
+
+    def _writeInfo(self, infoDir, micBase, boxes, mtimeOffset=0):
+        import json
+        from pyworkflow.utils import makePath
+        makePath(infoDir)
+        infoFn = os.path.join(infoDir, '%s_info.json' % micBase)
+        with open(infoFn, 'w') as f:
+            json.dump({'boxes': boxes}, f)
+        if mtimeOffset:
+            mtime = os.path.getmtime(infoFn) + mtimeOffset
+            os.utime(infoFn, (mtime, mtime))
+        return infoFn
+
+    def _createMics(self, *micIds, **kwargs):
+        mics = []
+        for micId in micIds:
+            mic = pwem.Micrograph()
+            mic.setFileName('%s/mic_%d.mrc' % (kwargs.get('micDir', 'mics'),
+                                               micId))
+            mic.setObjId(micId)
+            mics.append(mic)
+        return mics
+
+
+class TestEmanConvertedStacks(TestEmanConvertBase):
+    """ Registry of converted stacks reused between runs (no EMAN needed). """
+    def test_registry(self):
+        from eman2.convert import (registerConvertedStacks,
+                                   unregisterConvertedStacks,
+                                   findConvertedStacks, getHeaderKey)
+        sourceFn = os.path.abspath('input/particles.mrcs')
+        stackFn = os.path.abspath('run1/particles/mic_1.hdf')
+        self._writeFile(stackFn)
+        partSet = self._createParticles('registry.sqlite', sourceFn, 2)
+        self.assertIsNone(findConvertedStacks(partSet))
+
+        key = getHeaderKey(partSet.getFirstItem())
+        converted = {sourceFn: {'1': [stackFn, 0, key],
+                                '2': [stackFn, 1, key]}}
+        registerConvertedStacks(converted)
+        self.assertEqual(findConvertedStacks(partSet),
+                         [(0, stackFn), (1, stackFn)])
+        # the phase-flipped stack was not written
+        self.assertIsNone(findConvertedStacks(partSet, flip=True))
+
+        # the headers were written with another sampling rate
+        partSet2 = self._createParticles('registry2.sqlite', sourceFn, 2,
+                                         samplingRate=3.0)
+        self.assertNotEqual(getHeaderKey(partSet2.getFirstItem()), key)
+        self.assertIsNone(findConvertedStacks(partSet2))
+
+        # a stack modified after being registered is not reused
+        self._writeFile(stackFn, 'more data')
+        self.assertIsNone(findConvertedStacks(partSet))
+
+        registerConvertedStacks(converted)
+        self.assertIsNotNone(findConvertedStacks(partSet))
+        unregisterConvertedStacks([stackFn])
+        self.assertIsNone(findConvertedStacks(partSet))
+
+    def test_linkConvertedCtf(self):
+        from eman2.convert import linkConvertedCtf
+        from eman2.constants import STRUCFAC
+        stackFn = os.path.abspath('run2/particles/mic_1.hdf')
+        self._writeFile(stackFn)
+        self._writeFile('run2/info/mic_1_info.json', '{}')
+        self.assertFalse(linkConvertedCtf([stackFn], 'run3', 'run3/info'))
+        self.assertTrue(os.path.exists('run3/info/mic_1_info.json'))
+
+        self._writeFile(os.path.join('run2', STRUCFAC), '0.1 1.0')
+        self.assertTrue(linkConvertedCtf([stackFn], 'run3', 'run3/info'))
+
+
+class TestEmanLstOnly(TestEmanConvertBase):
+    """ .lst sets pointing to the input stacks (no EMAN needed). """
+    def test_lstOnly(self):
+        from eman2.convert import (writeSetOfParticles, canUseInputStacks,
+                                   getMrcSamplingRate, LstFile)
+        self._writeMrc('parts.mrcs', 3, 2.0)
+        self._writeMrc('parts.mrc', 3, 2.0)
+        self.assertAlmostEqual(getMrcSamplingRate('parts.mrcs'), 2.0)
+
+        partSet = self._createParticles('lstonly.sqlite', 'parts.mrcs', 3)
+        partSet.setSamplingRate(2.0)
+        self.assertTrue(canUseInputStacks(partSet))
+        writeSetOfParticles(partSet, 'lstonly/particles', lstOnly=True,
+                            setName='inputSet')
+        self.assertEqual(list(LstFile('lstonly/sets/inputSet.lst')),
+                         [(i, '../parts.mrcs') for i in range(1, 4)])
+
+        # EMAN would use another sampling rate or read a volume
+        partSet.setSamplingRate(3.0)
+        self.assertFalse(canUseInputStacks(partSet))
+        for fn in ['parts.mrc', 'parts.mrc:mrcs']:
+            partSet = self._createParticles('lstonly_%s.sqlite'
+                                            % fn.replace(':', '_'), fn, 1)
+            partSet.setSamplingRate(2.0)
+            self.assertFalse(canUseInputStacks(partSet))
+
+
+class TestEmanStructureFactorCache(TestEmanConvertBase):
+    """ Structure factor cache keys and linking (no EMAN needed). """
+    def test_key(self):
+        from eman2.convert import getStructureFactorKey
+        from eman2.protocols.protocol_ctf import RUNTIME_ARGS
+        partSet = self._createParticles('sfkey.sqlite', 'particles.mrcs', 3)
+
+        def getKey(args):
+            return getStructureFactorKey(partSet,
+                                         RUNTIME_ARGS.sub('', args).strip())
+
+        args = '--hires --voltage 300 --cs 2.700 --threads %d --minqual 0'
+        self.assertEqual(getKey(args % 1), getKey(args % 8))
+        self.assertNotEqual(getKey(args % 1),
+                            getKey(args.replace('--hires', '--lores') % 1))
+        key = getKey(args % 1)
+        partSet._firstDim.set((128, 128, 1))
+        self.assertNotEqual(key, getKey(args % 1))
+
+    def test_link(self):
+        from pyworkflow.utils import makePath
+        from eman2.convert import linkStructureFactor, cacheStructureFactor
+        from eman2.constants import STRUCFAC
+        partSet = self._createParticles('sflink.sqlite', 'particles.mrcs', 1)
+        for projectPath in ['sf1', 'sf2', 'sf3']:
+            makePath(projectPath)
+        self.assertFalse(linkStructureFactor(partSet, 'sf1', 'key'))
+
+        self._writeFile(os.path.join('sf1', STRUCFAC), '0.1 1.0')
+        cacheStructureFactor('sf1', 'key')
+        self.assertTrue(linkStructureFactor(partSet, 'sf2', 'key'))
+        self.assertFalse(linkStructureFactor(partSet, 'sf3', 'other'))
+
+        # the one of the EMAN project with the particles is copied
+        stackFn = os.path.join('sfrun', 'particles', 'mic_1.hdf')
+        self._writeFile(stackFn)
+        self._writeFile(os.path.join('sfrun', STRUCFAC), '0.2 1.0')
+        partSet = self._createParticles('sflink2.sqlite', stackFn, 1)
+        self.assertTrue(linkStructureFactor(partSet, 'sf3', 'other'))
+        self.assertFalse(os.path.islink(os.path.join('sf3', STRUCFAC)))
+
+
+class TestEmanConvNetCache(TestEmanConvertBase):
+    """ Neural net picker cache keys and linking (no EMAN needed). """
+    def test_keyAndLink(self):
+        from pyworkflow.utils import makePath
+        from eman2.convert import getConvNetKey, linkConvNet, cacheConvNet
+        from eman2.constants import CONVNET_FILES
+        goodRefs = self._createParticles('good1.sqlite', 'refs.mrcs', 2)
+        sameRefs = self._createParticles('good2.sqlite', 'refs.mrcs', 2)
+        otherRefs = self._createParticles('good3.sqlite', 'other.mrcs', 2)
+        key = getConvNetKey([goodRefs, None, None], 128, 100)
+        self.assertEqual(key, getConvNetKey([sameRefs, None, None], 128, 100))
+        self.assertNotEqual(key, getConvNetKey([goodRefs, None, None], 64, 100))
+        self.assertNotEqual(key, getConvNetKey([otherRefs, None, None],
+                                               128, 100))
+        # the references stack is written again at the same path
+        self._writeFile('refs.mrcs', 'new references')
+        self.assertNotEqual(key, getConvNetKey([goodRefs, None, None],
+                                               128, 100))
+        key = getConvNetKey([goodRefs, None, None], 128, 100)
+
+        for projectPath in ['net1', 'net2']:
+            makePath(projectPath)
+        self.assertFalse(linkConvNet('net1', key))
+        for fn in CONVNET_FILES:
+            self._writeFile(os.path.join('net1', fn))
+        cacheConvNet('net1', key)
+        self.assertTrue(linkConvNet('net2', key))
+
+
+class TestEmanCoordinates(TestEmanConvertBase):
+    """ Reading the boxer info files into coordinates (no EMAN needed). """
+    def test_infoIndex(self):
+        from eman2.convert import getInfoIndex
+        infoDir = os.path.abspath('index/info')
+        mic1Fn = self._writeInfo(infoDir, 'mic_1', [])
+        self.assertEqual(getInfoIndex(infoDir), {'mic_1': mic1Fn})
+
+        mic2Fn = self._writeInfo(infoDir, 'mic_2', [])
+        os.remove(mic1Fn)
+        self.assertEqual(getInfoIndex(infoDir, force=True), {'mic_2': mic2Fn})
+
+    def test_prefixedInfoNames(self):
+        import json
+        from eman2.convert import (CoordinatesTracker, findMicInfoFile,
+                                   getMicInfoName)
+        self.assertEqual(getMicInfoName('../Runs/000002_Import/extra/mic_1.mrc'),
+                         'extra-mic_1_info.json')
+        self.assertEqual(getMicInfoName('micrographs/mic_1.mrc'),
+                         'mic_1_info.json')
+
+        workDir = os.path.abspath('prefixed')
+        infoDir = os.path.join(workDir, 'info')
+        mic1Fn = self._writeInfo(infoDir, 'extra-mic_1', [[10, 20, 'auto']])
+        mic2Fn = self._writeInfo(infoDir, 'mic-2', [[30, 40, 'auto']])
+        with open(os.path.join(infoDir, 'project.json'), 'w') as f:
+            json.dump({'global.boxsize': 64}, f)
+        self.assertEqual(findMicInfoFile(infoDir, 'extra/mic_1.mrc'), mic1Fn)
+        # exact names are not confused with prefixed ones
+        self.assertEqual(findMicInfoFile(infoDir, 'mic-2.mrc'), mic2Fn)
+        self.assertIsNone(findMicInfoFile(infoDir, 'mic_3.mrc'))
+
+        mic = pwem.Micrograph()
+        mic.setFileName('Runs/000002_Import/extra/mic_1.mrc')
+        mic.setObjId(1)
+        coordSet = pwem.SetOfCoordinates(filename='prefixed.sqlite')
+        tracker = CoordinatesTracker(workDir, newBoxer=True)
+        self.assertEqual(tracker.readCoordinates([mic], coordSet), 1)
+
+    def test_tracker(self):
+        import json
+        from eman2.convert import CoordinatesTracker
+        workDir = os.path.abspath('tracker')
+        infoDir = os.path.join(workDir, 'info')
+        self._writeInfo(infoDir, 'mic_1', [[10, 20, 'auto'], [30, 40, 'auto']])
+        with open(os.path.join(infoDir, 'project.json'), 'w') as f:
+            json.dump({'global.boxsize': 64}, f)
+
+        mics = self._createMics(1, 2)
+        coordSet = pwem.SetOfCoordinates(filename='tracker.sqlite')
+        tracker = CoordinatesTracker(workDir, newBoxer=True)
+        self.assertEqual(tracker.readCoordinates(mics, coordSet), 2)
+        # nothing new to read
+        self.assertEqual(tracker.readCoordinates(mics, coordSet), 0)
+
+        # only the boxes appended by the boxer are read again
+        self._writeInfo(infoDir, 'mic_1', [[10, 20, 'auto'], [30, 40, 'auto'],
+                                           [50, 60, 'auto']], mtimeOffset=10)
+        self._writeInfo(infoDir, 'mic_2', [[70, 80, 'auto']])
+        self.assertEqual(tracker.readCoordinates(mics, coordSet), 2)
+        self.assertEqual(coordSet.getBoxSize(), 64)
+        self.assertEqual(sorted((c.getMicId(), c.getPosition())
+                                for c in coordSet),
+                         [(1, (10, 20)), (1, (30, 40)), (1, (50, 60)),
+                          (2, (70, 80))])
+
+
+class TestEmanImportCoordinates(TestEmanConvertBase):
+    """ Parsing of the imported coordinate files (no EMAN needed). """
+    class ImportProtocol(object):
+        """ Import protocol with the given files, only those in matching
+        have a micrograph.
+        """
+        def __init__(self, files, matching):
+            self.files = files
+            self.matching = matching
+
+        def getCopyOrLink(self):
+            return None
+
+        def iterFiles(self):
+            for fileId, fn in enumerate(self.files):
+                yield fn, fileId
+
+        def getMatchingMic(self, fileName, fileId):
+            return fileName if fileName in self.matching else None
+
+    def test_readFiles(self):
+        from eman2.convert.dataimport import (readBoxFile, readCoordinateFile,
+                                              EmanImport)
+        self._writeFile('read/one.box', '10 20 100 100\n')
+        self._writeFile('read/two.box', '10 20 100 100\n30 40 100 100\n')
+        self._writeFile('read/empty.box', '')
+        self._writeFile('read/bad.box', 'x y\n')
+        self._writeFile('read/one.json', '{"boxes": [[60, 70, "manual"]]}')
+        self._writeFile('read/nobox.json', '{}')
+        self._writeFile('read/empty.json', '')
+        self._writeFile('read/coords.star', 'data_\n')
+
+        self.assertEqual(readBoxFile('read/one.box').shape, (1, 3))
+        self.assertEqual(readBoxFile('read/empty.box').shape, (0, 3))
+        self.assertIsNone(readBoxFile('read/bad.box'))
+        self.assertEqual(readCoordinateFile('read/one.box').tolist(),
+                         [[60, 70]])
+        self.assertEqual(readCoordinateFile('read/two.box').tolist(),
+                         [[60, 70], [80, 90]])
+        self.assertEqual(readCoordinateFile('read/empty.box').shape, (0, 2))
+        self.assertIsNone(readCoordinateFile('read/bad.box'))
+        self.assertEqual(readCoordinateFile('read/one.json').tolist(),
+                         [[60, 70]])
+        self.assertEqual(readCoordinateFile('read/nobox.json').shape, (0, 2))
+        self.assertIsNone(readCoordinateFile('read/empty.json'))
+
+        emanImport = EmanImport(self.ImportProtocol([], []))
+        coords = []
+        emanImport.importCoordinates('read/empty.box', coords.append)
+        self.assertEqual(coords, [])
+        # .star files are not EMAN coordinates
+        self.assertRaises(Exception, emanImport.importCoordinates,
+                          'read/coords.star', coords.append)
+
+    def test_prefetch(self):
+        from eman2.convert.dataimport import EmanImport
+        files = []
+        for name in ['mic_1', 'mic_2', 'other']:
+            files.append(self._writeInfo('prefetch/info', name,
+                                         [[10, 20, 'manual']]))
+        emanImport = EmanImport(self.ImportProtocol(files, files[:2]))
+
+        coords = []
+        emanImport.importCoordinates(files[0], coords.append)
+        self.assertEqual(len(coords), 1)
+        # the other file with a micrograph is being read
+        self.assertEqual(list(emanImport._coordsResults), [files[1]])
+        emanImport.importCoordinates(files[1], coords.append)
+        self.assertIsNone(emanImport._coordsPool)
+
+        emanImport.importCoordinates(files[2], coords.append)
+        self.assertEqual([(c.getX(), c.getY()) for c in coords],
+                         [(10, 20)] * 3)
+        self.assertIsNone(emanImport._coordsPool)
+
+    def test_boxSizeCache(self):
+        from pyworkflow.utils import makePath
+        from eman2.convert import writeJson
+        from eman2.convert.dataimport import EmanImport
+        emanImport = EmanImport(self.ImportProtocol([], []))
+        self._writeFile('boxsize/boxes/mic_1.box', '10 20 100 100\n')
+        self._writeFile('boxsize/boxes/mic_2.box', '10 20 64 64\n')
+        self._writeFile('boxsize/empty/mic_1.box', '')
+        self.assertEqual(emanImport.getBoxSize('boxsize/boxes/mic_1.box'),
+                         100)
+        # read once per folder
+        self.assertEqual(emanImport.getBoxSize('boxsize/boxes/mic_2.box'),
+                         100)
+        self.assertIsNone(emanImport.getBoxSize('boxsize/empty/mic_1.box'))
+
+        makePath('boxsize/e2boxercache')
+        writeJson({'box_size': 128}, 'boxsize/e2boxercache/base.json')
+        infoFn = self._writeInfo('boxsize/info', 'mic_1', [])
+        self.assertEqual(emanImport.getBoxSize(infoFn), 128)
+
+
+class TestEmanPickerPreview(TestEmanConvertBase):
+    """ Micrographs and values of the gaussian picker wizard preview. """
+    def test_previewMics(self):
+        from pyworkflow.utils import makePath
+        from eman2.wizards import SparxGaussianPickerWizard, PREVIEW_MICS
+        makePath('preview/mics')
+        micSet = pwem.SetOfMicrographs(filename='preview/mics.sqlite')
+        micSet.setSamplingRate(2.0)
+        for i in range(1, PREVIEW_MICS + 3):
+            micFn = 'preview/mics/mic_%d.mrc' % i
+            self._writeMrc(micFn, 1, 2.0, size=256)
+            mic = pwem.Micrograph(location=micFn)
+            mic.setSamplingRate(2.0)
+            micSet.append(mic)
+        micSet.write()
+
+        wizard = SparxGaussianPickerWizard()
+        coordsDir = os.path.abspath('preview/coords')
+        makePath(coordsDir)
+        previewSet = wizard._getPreviewMics(micSet, coordsDir)
+        self.assertEqual(previewSet.getSize(), PREVIEW_MICS)
+        # the picking is previewed at the input sampling
+        self.assertEqual(previewSet.getSamplingRate(), 2.0)
+        for mic in previewSet:
+            self.assertEqual(mic.getSamplingRate(), 2.0)
+            self.assertTrue(os.path.exists(mic.getFileName()))
+        micIds = [mic.getObjId() for mic in previewSet]
+        previewSet.close()
+
+        # reused while the input set is not modified
+        previewSet = wizard._getPreviewMics(micSet, coordsDir)
+        self.assertEqual([mic.getObjId() for mic in previewSet], micIds)
+        previewSet.close()
+
+    def test_changedValues(self):
+        from eman2.wizards import SparxGaussianPickerWizard
+        params = ['boxSize', 'lowerThreshold', 'gaussWidth']
+        args = {'boxSize': 129, 'lowerThreshold': 0.004, 'gaussWidth': 0.525}
+        props = {'boxSize.value': '129', 'lowerThreshold.value': '0.01',
+                 'gaussWidth.value': ' 0.525'}
+        self.assertEqual(SparxGaussianPickerWizard()._getChangedValues(
+            params, args, props), {'lowerThreshold': '0.01'})
+
+
+class TestEmanJsonCache(TestEmanConvertBase):
+    """ Cache of the parsed json files (no EMAN needed). """
+    def test_writeInvalidates(self):
+        from eman2.convert import (loadJson, writeJson, clearJsonCache,
+                                   getJsonCacheStats)
+        clearJsonCache()
+        jsonFn = os.path.abspath('cache.json')
+        writeJson({'boxes': [[1, 2]]}, jsonFn)
+        self.assertEqual(loadJson(jsonFn), {'boxes': [[1, 2]]})
+        self.assertEqual(loadJson(jsonFn), {'boxes': [[1, 2]]})
+        stats = getJsonCacheStats()
+        self.assertEqual((stats['hits'], stats['misses']), (1, 1))
+
+        # same size and maybe same mtime, the write drops the cached dict
+        writeJson({'boxes': [[3, 4]]}, jsonFn)
+        self.assertEqual(loadJson(jsonFn), {'boxes': [[3, 4]]})
+        self.assertEqual(getJsonCacheStats()['misses'], 2)
+
+    def test_cachedDictNotModified(self):
+        import numpy
+        from eman2.convert import loadJson, writeJson, writeThresholdedBoxes
+        jsonFn = os.path.abspath('thresholded.json')
+        writeJson({'boxes': [[1, 2, 'manual']]}, jsonFn)
+        cached = loadJson(jsonFn)
+        numpy.save('candidates.npy', numpy.array([[10., 20., 0.9],
+                                                  [30., 40., 0.1]]))
+        self.assertEqual(writeThresholdedBoxes('candidates.npy', jsonFn,
+                                               0.5, 'auto'), 1)
+        self.assertEqual(cached, {'boxes': [[1, 2, 'manual']]})
+        self.assertEqual(loadJson(jsonFn)['boxes'],
+                         [[10., 20., 'auto', 0.9]])
+
+
+class TestEmanBoxingOutput(TestEmanConvertBase):
+    """ Re-read only the micrographs edited in a boxing session
+    (no EMAN needed).
+    """
+    def test_readEdited(self):
+        import json
+        workDir = os.path.abspath('boxing')
+        infoDir = os.path.join(workDir, 'info')
+        # EMAN prefixes the folder of the micrographs, e.g. Runs/.../extra
+        self._writeInfo(infoDir, 'extra-mic_1', [[10, 20, 'manual'],
+                                                 [30, 40, 'manual']])
+        self._writeInfo(infoDir, 'extra-mic_2', [[50, 60, 'manual']])
+        with open(os.path.join(infoDir, 'project.json'), 'w') as f:
+            json.dump({'global.boxsize': 64}, f)
+
+        prot = EmanProtBoxing(workingDir=workDir)
+        os.makedirs(prot._getExtraPath())
+        prot.inputMics = self._createMics(1, 2, 3, micDir='import/extra')
+        prot._getLastCoordinates = lambda: None
+        firstSet = pwem.SetOfCoordinates(filename='boxing1.sqlite')
+        prot.readSetOfCoordinates(workDir, firstSet)
+        firstSet.write()
+        self.assertEqual(firstSet.getSize(), 3)
+
+        # mic_2 is edited and mic_3 picked in the next session,
+        # mic_1 coordinates are copied
+        self._writeInfo(infoDir, 'extra-mic_2', [[70, 80, 'manual']],
+                        mtimeOffset=10)
+        self._writeInfo(infoDir, 'extra-mic_3', [[90, 100, 'manual']])
+        prot._getLastCoordinates = lambda: firstSet
+        secondSet = pwem.SetOfCoordinates(filename='boxing2.sqlite')
+        prot.readSetOfCoordinates(workDir, secondSet)
+        self.assertEqual(sorted((c.getMicId(), c.getPosition())
+                                for c in secondSet),
+                         [(1, (10, 20)), (1, (30, 40)), (2, (70, 80)),
+                          (3, (90, 100))])
+        self.assertEqual(sorted(prot._loadOutputMtimes()),
+                         ['boxing1.sqlite', 'boxing2.sqlite'])
+
+
+class TestEmanSetOfParticlesLst(TestEmanConvertBase):
+    """ Particle sets defined from a base set and an .lst file
+    (no EMAN needed).
+    """
+    def _createLstSet(self, setFn, baseSet, lstFn):
+        from eman2.objects import EmanSetOfParticlesLst
+        lstSet = EmanSetOfParticlesLst(filename=setFn)
+        lstSet._baseSet.set(baseSet)
+        lstSet._lstFile.set(lstFn)
+        lstSet.write()
+        return lstSet
+
+    def test_materialize(self):
+        from pyworkflow.utils import makePath
+        from eman2.convert import writeLstFile
+        baseSet = self._createParticles('lstbase.sqlite', 'particles.mrcs', 3)
+        part = baseSet[2]
+        part.setEnabled(False)
+        baseSet.update(part)
+        baseSet.write()
+        makePath('lst/sets')
+        lstFn = os.path.abspath('lst/sets/test.lst')
+        writeLstFile(lstFn, [(i, 'particles/mic_1.hdf') for i in range(3)])
+
+        lstSet = self._createLstSet('lstset.sqlite', baseSet, lstFn)
+        # as loaded from the project, the size is kept until materialized
+        lstSet.close()
+        lstSet._size.set(2)
+        self.assertFalse(lstSet.isMaterialized())
+        self.assertEqual(lstSet.getSize(), 2)
+        stackFn = os.path.abspath('lst/particles/mic_1.hdf')
+        self.assertEqual([p.getLocation() for p in lstSet],
+                         [(1, stackFn), (3, stackFn)])
+        self.assertTrue(lstSet.isMaterialized())
+
+        # the rows are written only once
+        lstSet.materialize()
+        self.assertEqual(
+            len(list(pwem.SetOfParticles(filename='lstset.sqlite'))), 2)
+
+    def test_missingLst(self):
+        baseSet = self._createParticles('lstbase2.sqlite', 'particles.mrcs', 1)
+        lstSet = self._createLstSet('lstset2.sqlite', baseSet,
+                                    os.path.abspath('missing/sets/test.lst'))
+        self.assertRaises(Exception, lstSet.isMaterialized)
+
+
+class TestEmanCtfAutoUpdate(BaseTest):
+    """ Detect the micrographs edited with the e2ctf.py GUI (no EMAN needed). """
+    @classmethod
+    def setUpClass(cls):
+        setupTestOutput(cls)
+
+    def test_changedInfoFiles(self):
+        import json
+        from pyworkflow.utils import makePath
+        prot = EmanProtCTFAuto(workingDir=self.getOutputPath('ctf'))
+        infoDir = prot._getExtraPath('info')
+        makePath(infoDir)
+        for micBase in ['mic_1', 'mic_2']:
+            with open(os.path.join(infoDir, '%s_info.json' % micBase), 'w') as f:
+                json.dump({'ctf': []}, f)
+
+        prot._saveInfoMtimes()
+        self.assertEqual(prot._getChangedInfoFiles(), set())
+
+        editedFn = os.path.join(infoDir, 'mic_2_info.json')
+        mtime = os.path.getmtime(editedFn) + 10
+        os.utime(editedFn, (mtime, mtime))
+        with open(os.path.join(infoDir, 'mic_3_info.json'), 'w') as f:
+            json.dump({'ctf': []}, f)
+        self.assertEqual(prot._getChangedInfoFiles(),
+                         set(['mic_2_info.json', 'mic_3_info.json']))
+
+
 class TestEmanAutopick(TestEmanBase):
     @classmethod
     def setUpClass(cls):
@@ -387,3 +1107,51 @@ class TestEmanAutopick(TestEmanBase):
                                  "There was a problem with e2boxer gauss auto protocol")
         else:
             print("Auto picking with gauss/sparx does not work in EMAN 2.21. Skipping test..")
+
+    def test_AutopickSparxNumpy(self):
+        print("Run gauss/sparx auto picking with the NumPy engine")
+        args = dict(boxSize=128, lowerThreshold=0.004, higherThreshold=0.1,
+                    gaussWidth=0.525, useVarImg=False, doInvert=True)
+        protPick = self.newProtocol(SparxGaussianProtPicking,
+                                    pickerEngine=1, **args)
+        protPick.inputMicrographs.set(self.protImportMics.outputMicrographs)
+        self.launchProtocol(protPick)
+        self.assertIsNotNone(protPick.outputCoordinates,
+                             "There was a problem with the NumPy gauss picker")
+
+        if not eman2.Plugin.isNewVersion():
+            print("Compare with the EMAN gauss/sparx picker")
+            protPickEman = self.newProtocol(SparxGaussianProtPicking, **args)
+            protPickEman.inputMicrographs.set(
+                self.protImportMics.outputMicrographs)
+            self.launchProtocol(protPickEman)
+            # most particles are picked by both, a few pixels apart
+            coords = self._getCoordinates(protPick.outputCoordinates)
+            emanCoords = self._getCoordinates(protPickEman.outputCoordinates)
+            for coords1, coords2 in [(coords, emanCoords),
+                                     (emanCoords, coords)]:
+                matched = sum(self._countNear(coords1[micId],
+                                              coords2.get(micId, []), 16)
+                              for micId in coords1)
+                total = sum(len(c) for c in coords1.values())
+                self.assertGreaterEqual(matched, 0.8 * total,
+                                        "Only %d of %d particles matched"
+                                        % (matched, total))
+
+    def _getCoordinates(self, coordSet):
+        """ Return a dict with the list of (x, y) of each micrograph. """
+        coords = {}
+        for coord in coordSet:
+            coords.setdefault(coord.getMicId(), []).append(
+                (coord.getX(), coord.getY()))
+        return coords
+
+    def _countNear(self, coords, otherCoords, distance):
+        """ Count the coords with another one closer than distance. """
+        import numpy
+        if not len(otherCoords):
+            return 0
+        a = numpy.array(coords, dtype=float)[:, None, :]
+        b = numpy.array(otherCoords, dtype=float)[None, :, :]
+        dists = numpy.sqrt(((a - b) ** 2).sum(axis=2))
+        return int((dists.min(axis=1) <= distance).sum())
@@ -43,6 +43,7 @@ import pyworkflow.utils as pwutils
 import eman2
 from eman2.constants import *
 from eman2.convert import loadJson
+from eman2.objects import EmanSetOfParticlesLst
 from eman2.protocols import (EmanProtBoxing, EmanProtCTFAuto,
                              EmanProtInitModel, EmanProtRefine2D,
                              EmanProtRefine2DBispec, EmanProtRefine,
@@ -872,6 +873,9 @@ class CtfViewer(ProtocolViewer):
         views = []
         obj = "obj = self.protocol." + self.getEnumText('outputType')
         exec (obj)
+        if isinstance(obj, EmanSetOfParticlesLst):
+            # showj reads the sqlite file, so the rows must be there
+            obj.materialize()
         strId = obj.strId()
         fn = obj.getFileName()
         particlesView = ObjectView(self._project, strId, fn)
@@ -895,12 +899,12 @@ class CtfViewer(ProtocolViewer):
         # Open dialog to request confirmation to overwrite output
         saveChanges = askYesNo("Save output changes?",
                                "Do you want to overwrite output particles with new CTF values?\n"
-                               "This may take a while depending on the set size.",
+                               "Only particles from modified micrographs will be updated.",
                                self.getTkRoot())
         if saveChanges:
-            self.protocol.createOutputStep()
+            count = self.protocol.updateOutputCtf()
             showInfo("Output updated",
-                          "Output particles were updated with new CTF values.",
+                          "%d output particles were updated with new CTF values." % count,
                           self.getTkRoot())
 
     def _load(self):
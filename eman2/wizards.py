@@ -25,20 +25,29 @@
 # **************************************************************************
 
 import os
+import random
+import subprocess
 
 import pyworkflow as pw
+from pyworkflow.em.data import SetOfMicrographs
 from pyworkflow.em.wizard import EmWizard
 from pyworkflow.em.viewers import CoordinatesObjectView
-from pyworkflow.utils import makePath, cleanPath, readProperties
+from pyworkflow.utils import (makePath, cleanPath, readProperties,
+                              removeBaseExt)
 
 import eman2
 from eman2.convert import writeSetOfMicrographs
 from eman2.protocols import SparxGaussianProtPicking
+from eman2.constants import GAUSS_NUMPY
+from eman2.convert import gausspicker
 
 # =============================================================================
 # PICKER
 # =============================================================================
 
+# Number of random micrographs shown by the picker preview
+PREVIEW_MICS = 10
+
 class SparxGaussianPickerWizard(EmWizard):
     _targets = [(SparxGaussianProtPicking, ['boxSize',
                                             'lowerThreshold', 'higherThreshold',
@@ -56,13 +65,19 @@ class SparxGaussianPickerWizard(EmWizard):
             autopickProt.boxSize.set(100)
 
         project = autopickProt.getProject()
-        coordsDir = project.getTmpPath(micSet.getName())
-
-        cleanPath(coordsDir)
+        boxSize = autopickProt.boxSize.get()
+        # The subset of micrographs is kept between previews (while the
+        # input set is not modified), only the picking results are removed.
+        # The micrographs are not downsampled: the thresholds depend on
+        # the sampling, so they are tuned as they will be used.
+        coordsDir = project.getTmpPath('eman2_preview_%s' % micSet.strId())
         makePath(coordsDir)
+        for path in ['info', 'e2boxercache']:
+            cleanPath(os.path.join(coordsDir, path))
 
+        previewSet = self._getPreviewMics(micSet, coordsDir)
         micMdFn = os.path.join(coordsDir, "micrographs.xmd")
-        writeSetOfMicrographs(micSet, micMdFn)
+        writeSetOfMicrographs(previewSet, micMdFn)
 
         pickerProps = os.path.join(coordsDir, 'picker.conf')
         f = open(pickerProps, "w")
@@ -81,14 +96,35 @@ class SparxGaussianPickerWizard(EmWizard):
             "picker": "%s %s" % (pw.getScipionScript(), program),
             "convert": pw.join('apps', 'pw_convert.py'),
             'coordsDir': coordsDir,
-            'micsSqlite': micSet.getFileName(),
-            "boxSize": autopickProt.boxSize,
+            'micsSqlite': previewSet.getFileName(),
+            "boxSize": boxSize,
             "lowerThreshold": autopickProt.lowerThreshold,
             "higherThreshold": autopickProt.higherThreshold,
             "gaussWidth": autopickProt.gaussWidth,
             "extraParams": extraParams
         }
 
+        if autopickProt.pickerEngine.get() == GAUSS_NUMPY:
+            gaussPicker = '%s python %s --boxsize=%%(boxSize)' % (
+                pw.getScipionScript(),
+                os.path.splitext(gausspicker.__file__)[0] + '.py')
+            args['preprocessCommand'] = gaussPicker + ' --init'
+            args['autopickCommand'] = (
+                '%s --gauss_width=%%(gaussWidth) --thr_low=%%(lowerThreshold) '
+                '--thr_hi=%%(higherThreshold)%s%s %%(micrograph)'
+                % (gaussPicker,
+                   ' --invert' if autopickProt.doInvert else '',
+                   ' --variance' if autopickProt.useVarImg else ''))
+        else:
+            args['preprocessCommand'] = (
+                '%(preprocess)s demoparms --makedb=thr_low=%%(lowerThreshold):'
+                'thr_hi=%%(higherThreshold):boxsize=%%(boxSize):'
+                'gauss_width=%%(gaussWidth):%(extraParams)s' % args)
+            args['autopickCommand'] = (
+                '%(picker)s --gauss_autoboxer=demoparms --write_dbbox '
+                '--boxsize=%%(boxSize) --norm=normalize.ramp.normvar '
+                '%%(micrograph)' % args)
+
         f.write("""
         parameters = %(params)s
         boxSize.value = %(boxSize)s
@@ -104,8 +140,8 @@ class SparxGaussianPickerWizard(EmWizard):
         gaussWidth.value =  %(gaussWidth)s
         gaussWidth.label = Gauss Width
         runDir = %(coordsDir)s
-        preprocessCommand = %(preprocess)s demoparms --makedb=thr_low=%%(lowerThreshold):thr_hi=%%(higherThreshold):boxsize=%%(boxSize):gauss_width=%%(gaussWidth):%(extraParams)s
-        autopickCommand = %(picker)s --gauss_autoboxer=demoparms --write_dbbox --boxsize=%%(boxSize) --norm=normalize.ramp.normvar %%(micrograph) 
+        preprocessCommand = %(preprocessCommand)s
+        autopickCommand = %(autopickCommand)s
         convertCommand = %(convert)s --coordinates --from eman2 --to xmipp --input  %(micsSqlite)s --output %(coordsDir)s
         """ % args)
         f.close()
@@ -116,5 +152,55 @@ class SparxGaussianPickerWizard(EmWizard):
         myprops = readProperties(pickerProps)
 
         if myprops['applyChanges'] == 'true':
-            for param in params:
-                form.setVar(param, myprops[param + '.value'])
+            for param, value in self._getChangedValues(params, args,
+                                                       myprops).items():
+                form.setVar(param, value)
+
+    def _getChangedValues(self, params, args, props):
+        """ Return a dict with the values modified in the preview. """
+        values = {}
+        for param in params:
+            value = props[param + '.value']
+            if str(value).strip() != str(args[param]).strip():
+                values[param] = value
+        return values
+
+    def _getPreviewMics(self, micSet, coordsDir):
+        """ Return a random subset of micrographs, converted to hdf.
+        The subset is stored in coordsDir and reused by later previews,
+        unless the input set file was modified.
+        """
+        previewFn = os.path.join(coordsDir, 'micrographs.sqlite')
+        keyFn = os.path.join(coordsDir, 'preview.key')
+        st = os.stat(micSet.getFileName())
+        key = '%s %s %d %r' % (os.path.abspath(micSet.getFileName()),
+                               micSet.strId(), st.st_size, st.st_mtime)
+        if os.path.exists(previewFn) and os.path.exists(keyFn):
+            with open(keyFn) as f:
+                if f.read() == key:
+                    return SetOfMicrographs(filename=previewFn)
+
+        cleanPath(coordsDir)
+        makePath(coordsDir)
+
+        micIds = [mic.getObjId() for mic in micSet.iterItems()]
+        micIds = sorted(random.sample(micIds, min(PREVIEW_MICS, len(micIds))))
+
+        previewSet = SetOfMicrographs(filename=previewFn)
+        previewSet.copyInfo(micSet)
+        for micId in micIds:
+            mic = micSet[micId]
+            micFn = os.path.join(coordsDir,
+                                 '%s.hdf' % removeBaseExt(mic.getFileName()))
+            subprocess.check_call(
+                eman2.Plugin.getEmanCommand('e2proc2d.py', '%s %s' % (
+                    mic.getFileName(), micFn)),
+                shell=True, env=eman2.Plugin.getEnviron())
+            mic.setFileName(micFn)
+            previewSet.append(mic)
+        previewSet.write()
+        previewSet.close()
+        with open(keyFn, 'w') as f:
+            f.write(key)
+
+        return SetOfMicrographs(filename=previewFn)